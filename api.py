@@ -0,0 +1,217 @@
+from typing import Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import time
+
+from pydantic import BaseModel, ValidationError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
+
+from config import app_settings
+from location import LOCATION_DESCRIPTION, get_exchange_rate_provider
+from metrics import API_REQUEST_SECONDS, REGISTRY, profile_if_slow
+from recommendations import get_cheapest_offers, get_recommended_product, get_recommended_products, get_size_offers
+from resilience import CircuitOpen
+from scheduler import SerpThrottled
+from schemas import GetCheapestOffersRequest, GetProductRequest, GetProductsRequest, GetSizeOffersRequest
+
+logger = logging.getLogger(__name__)
+
+# SerpAPI calls block, they run on a bounded pool of worker threads while the
+# event loop only parses requests and writes responses
+executor: ThreadPoolExecutor | None = None
+concurrency_limit: asyncio.Semaphore | None = None
+
+
+def error_response(status_code: int, error: str) -> JSONResponse:
+    return JSONResponse({"error": error}, status_code=status_code)
+
+
+def call_profiled(fn: Callable[..., BaseModel], **kwargs) -> BaseModel:
+    with profile_if_slow(fn.__name__):
+        return fn(**kwargs)
+
+
+async def run_in_worker(fn: Callable[..., BaseModel], **kwargs) -> Response:
+    try:
+        await asyncio.wait_for(concurrency_limit.acquire(), timeout=app_settings.api_queue_timeout)
+    except asyncio.TimeoutError:
+        return error_response(503, "Too many concurrent requests")
+
+    def release(future: asyncio.Future) -> None:
+        concurrency_limit.release()
+        # nobody awaits a call that timed out, its error is read here instead of logged as never retrieved
+        if not future.cancelled():
+            future.exception()
+
+    # the slot is held until the worker thread is done, a timed out call still occupies it
+    future = asyncio.get_running_loop().run_in_executor(executor, lambda: call_profiled(fn, **kwargs))
+    future.add_done_callback(release)
+
+    try:
+        result = await asyncio.wait_for(asyncio.shield(future), timeout=app_settings.api_request_timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"{fn.__name__} timed out after {app_settings.api_request_timeout}s")
+        return error_response(504, "Request timed out")
+    except CircuitOpen as e:
+        logger.warning(f"{fn.__name__} failed fast: {e.reason}")
+        return error_response(503, "Search is unavailable for this location, try again later")
+    except SerpThrottled as e:
+        logger.warning(f"{fn.__name__} throttled: {e.reason}")
+        return error_response(429, "SerpAPI quota exhausted, try again later")
+    except Exception:
+        logger.exception(f"{fn.__name__} failed")
+        return error_response(502, "Upstream search failed")
+
+    return Response(result.model_dump_json(), media_type="application/json")
+
+
+async def validate_body(request: Request, request_model: type[BaseModel]) -> BaseModel | Response:
+    try:
+        return request_model.model_validate_json(await request.body())
+    except ValidationError as e:
+        # the input is left out, it can be raw bytes that do not serialize
+        errors = e.errors(include_url=False, include_input=False, include_context=False)
+        if any(error["type"] == "json_invalid" for error in errors):
+            return error_response(400, "Invalid JSON")
+        return JSONResponse({"error": "Invalid request", "details": errors}, status_code=422)
+
+
+async def parse_request(request: Request, request_model: type[BaseModel]) -> BaseModel | Response:
+    payload = await validate_body(request, request_model)
+    if isinstance(payload, Response):
+        return payload
+
+    if payload.location not in LOCATION_DESCRIPTION:
+        return error_response(422, f"Unknown location {payload.location}")
+
+    return payload
+
+
+async def get_products(request: Request) -> Response:
+    payload = await parse_request(request, GetProductsRequest)
+    if isinstance(payload, Response):
+        return payload
+
+    return await run_in_worker(
+        get_recommended_products,
+        query=payload.query,
+        location=payload.location,
+        debug_mode=app_settings.debug_mode
+    )
+
+
+async def get_product(request: Request) -> Response:
+    payload = await parse_request(request, GetProductRequest)
+    if isinstance(payload, Response):
+        return payload
+
+    return await run_in_worker(
+        get_recommended_product,
+        product_id=payload.product_id,
+        location=payload.location,
+        debug_mode=app_settings.debug_mode
+    )
+
+
+async def get_sizes(request: Request) -> Response:
+    payload = await parse_request(request, GetSizeOffersRequest)
+    if isinstance(payload, Response):
+        return payload
+
+    return await run_in_worker(
+        get_size_offers,
+        product_id=payload.product_id,
+        location=payload.location,
+        sizes=payload.sizes,
+        debug_mode=app_settings.debug_mode
+    )
+
+
+async def get_cheapest(request: Request) -> Response:
+    payload = await validate_body(request, GetCheapestOffersRequest)
+    if isinstance(payload, Response):
+        return payload
+
+    unknown_locations = [location for location in payload.locations or [] if location not in LOCATION_DESCRIPTION]
+    if unknown_locations:
+        return error_response(422, f"Unknown locations {', '.join(unknown_locations)}")
+
+    return await run_in_worker(
+        get_cheapest_offers,
+        query=payload.query,
+        locations=payload.locations or list(LOCATION_DESCRIPTION.keys()),
+        limit=payload.limit,
+        debug_mode=app_settings.debug_mode
+    )
+
+
+async def metrics(request: Request) -> Response:
+    return PlainTextResponse(REGISTRY.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+async def metrics_json(request: Request) -> Response:
+    return JSONResponse(REGISTRY.to_dict())
+
+
+async def health(request: Request) -> Response:
+    health_info: dict[str, Any] = {
+        "status": "ok",
+        "exchange_rates_staleness": get_exchange_rate_provider().staleness(),
+    }
+    return JSONResponse(health_info)
+
+
+async def time_requests(request: Request, call_next: Callable) -> Response:
+    started_at = time.perf_counter()
+    response = await call_next(request)
+
+    # unknown paths share a label, scanners would otherwise blow up the series count
+    endpoint = request.url.path if request.url.path in ENDPOINTS else "other"
+    API_REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=endpoint, status=str(response.status_code))
+
+    return response
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    global executor, concurrency_limit
+
+    executor = ThreadPoolExecutor(max_workers=app_settings.api_workers, thread_name_prefix="api-worker")
+    concurrency_limit = asyncio.Semaphore(app_settings.api_max_concurrency)
+    # loads the last snapshot and starts refreshing before the first request
+    get_exchange_rate_provider()
+
+    yield
+
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+routes = [
+    Route("/getProducts", get_products, methods=["POST"]),
+    Route("/getProduct", get_product, methods=["POST"]),
+    Route("/getSizeOffers", get_sizes, methods=["POST"]),
+    Route("/getCheapestOffers", get_cheapest, methods=["POST"]),
+    Route("/health", health, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/metrics.json", metrics_json, methods=["GET"]),
+]
+ENDPOINTS = {route.path for route in routes}
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(BaseHTTPMiddleware, dispatch=time_requests)],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host=app_settings.api_host, port=app_settings.api_port)
@@ -1,173 +1,86 @@
-import json
-
-from datetime import date
-
-
-from location import LOCATION_DESCRIPTION, get_exchange_rates, get_exchanged_amount
-from google_client import GoogleClient
+from columnar import SORT_OPTIONS, ProductColumns
+from config import app_settings
+from image_cache import get_image_cache
+from location import LOCATION_DESCRIPTION, get_exchange_rate_provider
+from metrics import RENDER_SECONDS, profile_if_slow, start_metrics_server
+from prefetch import OfferPrefetcher
+from ranking import rank_offers
+from result_store import get_result_store
+from recommendations import (
+    get_recommended_product,
+    get_recommended_products,
+    iter_recommended_product_pages,
+    iter_recommended_products,
+    iter_size_offers,
+    merge_recommended_products,
+)
 from schemas import (
-    GoogleShoppingProduct, 
-    GoogleShoppingProductsResponse, 
-    GoogleShoppingProductOffer, 
-    GoogleShoppingProductResponse,
     RecommendedProduct,
     RecommendedProductOffer,
-    ProductFilter,
-    ProductFilterValue,
     GetProductResponse,
     GetProductsResponse,
+    GetSizeOffersResponse,
 )
+from pydantic import BaseModel
 import streamlit as st
+import math
 
-debug_mode = False
+debug_mode = app_settings.debug_mode
 
-# GOOGLE 2 API
+# SESSION
 
-def prepare_recommended_product(google_product: GoogleShoppingProduct, location:str) -> RecommendedProduct:
-    exchange_rates: dict[str, float] = st.session_state["exchange_rates"]
-
-    offer = RecommendedProductOffer(
-        supplier=google_product.source,
-        link=google_product.link,
-        price=get_exchanged_amount(
-            price=google_product.price, 
-            location=location, 
-            exchange_rates=exchange_rates
-        ),
-        location=location
-    )
+# sessions keep keys into the process-wide result store, users running the same
+# search share one copy; results read from the store are shared, never mutate them
+def get_session_result(name: str) -> BaseModel | None:
+    key: str | None = st.session_state.get(name)
+    if key is None:
+        return None
 
-    return RecommendedProduct(
-        id=google_product.product_id,
-        title=google_product.title,
-        images=[google_product.thumbnail],
-        has_more_offers=google_product.number_of_comparisons is not None,
-        more_offers_text=google_product.number_of_comparisons,
-        # TODO remove from API
-        google_product_link=google_product.product_link,
-        offers=[offer]
-    )
+    result = get_result_store().get(key)
+    if result is None:
+        # evicted under memory pressure, the search has to be run again
+        st.session_state[name] = None
+    return result
 
-def prepare_recommended_product_offer(google_product_offer: GoogleShoppingProductOffer, location:str) -> RecommendedProductOffer:
-    exchange_rates: dict[str, float] = st.session_state["exchange_rates"]   
-
-    return RecommendedProductOffer(
-        supplier=google_product_offer.name,
-        is_high_quality=google_product_offer.top_quality_store,
-        # TODO parse non-google link
-        link=google_product_offer.link,
-        price=get_exchanged_amount(
-            price=google_product_offer.base_price, 
-            location=location, 
-            exchange_rates=exchange_rates
-        ),
-        shipping=get_exchanged_amount(
-            price=google_product_offer.additional_price.shipping, 
-            location=location, 
-            exchange_rates=exchange_rates
-        ) if google_product_offer.additional_price else None,
-        tax=get_exchanged_amount(
-            price=google_product_offer.additional_price.tax, 
-            location=location, 
-            exchange_rates=exchange_rates
-        ) if google_product_offer.additional_price else None,
-        total_price=get_exchanged_amount(
-            price=google_product_offer.total_price, 
-            location=location, 
-            exchange_rates=exchange_rates
-        ),
-        # TODO parse from string
-        # delivery_by=None,
-        location=location
-    )
+def set_session_result(name: str, result: BaseModel | None) -> None:
+    st.session_state[name] = get_result_store().put(result) if result is not None else None
 
+# GOOGLE 2 API
 
-def get_recommended_products(query:str, location:str, debug_mode: bool) -> GetProductsResponse:
-    if debug_mode:
-        with open("./example-shopping-products.json", "r") as fp:
-            response = GoogleShoppingProductsResponse(**json.load(fp))
-    else:
-        response = GoogleClient().get_products(query=query, location=location)
-
-    google_products = response.shopping_results 
-    # + response.related_shopping_results
-    # TODO dedupe
-
-    filters = []
-
-    for google_filter in response.filters:
-        if google_filter.type.lower() == "size":
-            filters.append(
-                ProductFilter(
-                    name="size",
-                    values=[
-                        ProductFilterValue(text=gfo.text or "10", key=gfo.tbs) 
-                        for gfo in google_filter.options
-                    ]
-                )
-            )
-    
-    products = [prepare_recommended_product(google_product=gp, location=location) for gp in google_products]
+def prefetch_recommended_product_offers(response: GetProductsResponse) -> None:
+    if not app_settings.offers_prefetch_top_n or debug_mode:
+        return
 
-    return GetProductsResponse(
-        filters=filters,
-        products=products
-    )
+    if "offer_prefetcher" not in st.session_state:
+        st.session_state["offer_prefetcher"] = OfferPrefetcher(budget=app_settings.offers_prefetch_budget)
 
-def get_recommended_product(product_id:str, location:str, debug_mode: bool) -> GetProductResponse:
-    
-    if debug_mode:
-        with open("./example-shopping-product.json", "r") as fp:
-            response = GoogleShoppingProductResponse(**json.load(fp))
-    else:
-        response = GoogleClient().get_product(product_id=product_id, location=location)
-
-    selected_filters = []
-
-    for size, size_data in response.product_results.sizes.items():
-        if size_data.selected:
-            selected_filters.append(
-                ProductFilter(
-                    name="size",
-                    values=[ProductFilterValue(text=size, key=size_data.product_id, is_selected=True)]
-                )
-            )
-
-    offers = [
-        prepare_recommended_product_offer(google_product_offer=gpo, location=location) 
-        for gpo in response.sellers_results.online_sellers
-    ]
-
-    images = [
-        m.link
-        for m in response.product_results.media
-        if m.type == "image"
-    ]
-
-    return GetProductResponse(
-        selected_filters=selected_filters,
-        product=RecommendedProduct(
-            id=response.product_results.product_id,
-            title=response.product_results.title,
-            images=images,
-            offers=offers,
-        )
-    )
-    
+    prefetcher: OfferPrefetcher = st.session_state["offer_prefetcher"]
+    prefetcher.prefetch([
+        (p.id, p.offers[0].location) 
+        for p in response.products[:app_settings.offers_prefetch_top_n] 
+        if p.has_more_offers
+    ])
 
 def get_more_offers_on_click(product_id:str, location:str, debug_mode: bool):
-    st.session_state["recommended_product"] = get_recommended_product(
+    prefetcher: OfferPrefetcher | None = st.session_state.get("offer_prefetcher")
+
+    if prefetcher and not debug_mode:
+        recommended_product = prefetcher.get(product_id=product_id, location=location, timeout=app_settings.serp_api_timeout)
+        if recommended_product:
+            set_session_result("recommended_product", recommended_product)
+            return
+
+    set_session_result("recommended_product", get_recommended_product(
         product_id=product_id,
         location=location,
         debug_mode=debug_mode
-    )
+    ))
 
 
 # SHOW
 
-def show_recommended_product_offers(container: st):
-    response:GetProductResponse = st.session_state["recommended_product"]
-
+@RENDER_SECONDS.timed(view="recommended_product_offers")
+def show_recommended_product_offers(container: st, response: GetProductResponse):
     recommended_product_offers:list[RecommendedProductOffer] = response.product.offers
 
     for o in recommended_product_offers:
@@ -179,17 +92,42 @@ def show_recommended_product_offers(container: st):
         
         col_price.text(f"Price: {o.price.original_amount} {o.price.original_currency}, {o.price.amount} UAH \nTotal: {o.total_price.original_amount} {o.total_price.original_currency}, {o.total_price.amount}UAH")
 
-def show_recommended_products(container: st) -> None:
-    response:GetProductsResponse = st.session_state["recommended_products"]
+@RENDER_SECONDS.timed(view="cheapest_offers")
+def show_cheapest_offers(container: st, products: list[RecommendedProduct]) -> None:
+    for ranked in rank_offers(products, k=app_settings.ranking_top_k):
+        o = ranked.offer
+        col_title, col_link, col_price = container.columns([4,2,3])
+
+        col_title.write(f"[{o.location}] {ranked.title}")
+        col_link.markdown(f"[{o.supplier}]({o.link})")
+        estimated = " (estimated)" if ranked.shipping_estimated or ranked.tax_estimated else ""
+        col_price.write(f"{ranked.landed_cost} UAH delivered{estimated}")
+
+@RENDER_SECONDS.timed(view="recommended_products")
+def show_recommended_products(
+        container: st, 
+        response: GetProductsResponse | None = None, 
+        wait_for_images: bool = True
+    ) -> None:
+    response:GetProductsResponse = response or get_session_result("recommended_products")
 
     recommended_products:list[RecommendedProduct] = response.products
 
+    # thumbnails of the whole page are fetched side by side, local copies from earlier renders are read from disk;
+    # streamed rows do not wait, images not cached yet load from their remote URL and are cached in the background
+    image_cache = get_image_cache()
+    cached_images = image_cache.fetch_many(
+        [p.images[0] for p in recommended_products if p.images], 
+        timeout=None if wait_for_images else 0
+    ) if image_cache else {}
+
     for p in recommended_products:
 
         offer = p.offers[0]
 
         col_image, col_title, col_link, col_price, col_button = container.columns(5)
-        col_image.image(p.images[0])
+        if p.images:
+            col_image.image(str(cached_images.get(p.images[0]) or p.images[0]))
         col_title.write(
             f"[{offer.location}] {p.title}"
         )
@@ -197,37 +135,160 @@ def show_recommended_products(container: st) -> None:
         col_price.write(f"{offer.price.original_amount} {offer.price.original_currency} \n{offer.price.amount} UAH")
         col_button.button(
             "Get more Offers", 
-            key=f"offers_{p.id}", 
+            key=f"offers_{offer.location}_{p.id}", 
             on_click=get_more_offers_on_click, 
             kwargs={"product_id":p.id, "location":offer.location, "debug_mode":debug_mode}
         )
 
+def get_recommended_products_columns(response: GetProductsResponse) -> ProductColumns:
+    key: str | None = st.session_state.get("recommended_products")
+    # ranked against the query that found the products, not what the search box holds now
+    query: str | None = st.session_state.get("recommended_products_query")
+
+    # built once per stored result and evicted with it, widget reruns only read the arrays
+    columns: ProductColumns | None = get_result_store().get_derived(
+        key, 
+        ("columns", query), 
+        lambda result: ProductColumns(result.products, query=query),
+        size_of=ProductColumns.nbytes
+    ) if key else None
+
+    return columns or ProductColumns(response.products, query=query)
+
+@RENDER_SECONDS.timed(view="filtered_recommended_products")
+def show_filtered_recommended_products(container: st, response: GetProductsResponse) -> None:
+    columns = get_recommended_products_columns(response)
+
+    col_price, col_locations, col_sort = container.columns([3,3,2])
+
+    min_price, max_price = columns.price_range()
+    price_range = (math.floor(min_price), math.ceil(max_price))
+    selected_price_range = col_price.slider(
+        "Price, UAH", min_value=price_range[0], max_value=price_range[1], value=price_range
+    ) if price_range[0] < price_range[1] else price_range
+
+    location_facets = columns.location_facets()
+    locations = col_locations.multiselect(
+        "Locations", 
+        options=list(location_facets), 
+        default=list(location_facets), 
+        format_func=lambda location: f"{location} ({location_facets[location]})"
+    )
+    sort_by = col_sort.selectbox("Sort by", SORT_OPTIONS)
+
+    # untouched price bounds keep the products without a price
+    price_filtered = selected_price_range != price_range
+    mask = columns.mask(
+        min_price=selected_price_range[0] if price_filtered else None,
+        max_price=selected_price_range[1] if price_filtered else None,
+        locations=locations,
+    )
+    indices = columns.sort(mask, by=sort_by)
 
-def show():
+    shown_min_price, shown_max_price = columns.price_range(mask)
+    container.caption(
+        f"Shown {min(len(indices), app_settings.results_page_size)} of {len(indices)} matching, "
+        f"{len(columns)} total, price range {shown_min_price:.0f}-{shown_max_price:.0f} UAH"
+    )
+
+    show_recommended_products(
+        container, 
+        response.model_copy(update={"products": columns.take(indices[:app_settings.results_page_size])})
+    )
 
-    if "exchange_rates" not in st.session_state:
-        st.session_state["exchange_rates"] = get_exchange_rates(date.today())
+def show_recommended_products_stream(container: st, query: str, locations: list[str]) -> GetProductsResponse:
+    progress = container.progress(0.0, text=f"Searching {len(locations)} locations...")
 
-    if "recommended_products" not in st.session_state:
-        st.session_state["recommended_products"] = []
-    
-    if "recommended_product" not in st.session_state:
-        st.session_state["recommended_product"] = []
+    location_cols = container.columns(len(locations))
+    location_statuses = {location: location_cols[idx].empty() for idx, location in enumerate(locations)}
+    for location, location_status in location_statuses.items():
+        location_status.write(f"⏳ {LOCATION_DESCRIPTION[location]}")
+
+    responses = []
+
+    for idx, (location, response) in enumerate(
+        iter_recommended_products(query=query, locations=locations, debug_mode=debug_mode), 
+        start=1
+    ):
+        if response is None:
+            location_statuses[location].write(f"❌ {LOCATION_DESCRIPTION[location]}")
+        else:
+            location_statuses[location].write(f"✅ {LOCATION_DESCRIPTION[location]}: {len(response.products)}")
+            show_recommended_products(container, response, wait_for_images=False)
+            responses.append(response)
+
+        progress.progress(idx/len(locations), text=f"Searched {idx} of {len(locations)} locations")
+
+    return merge_recommended_products(responses)
+
+def show_recommended_product_pages_stream(container: st, query: str, location: str) -> GetProductsResponse:
+    status = container.empty()
+    status.write(f"⏳ Searching {app_settings.deep_search_pages} pages...")
+
+    responses = []
+
+    for response in iter_recommended_product_pages(query=query, location=location, debug_mode=debug_mode):
+        show_recommended_products(container, response, wait_for_images=False)
+        responses.append(response)
+        status.write(f"⏳ {sum(len(r.products) for r in responses)} products found...")
+
+    status.write(f"✅ {sum(len(r.products) for r in responses)} products found")
+
+    return merge_recommended_products(responses)
+
+def get_size_offers_rows(matrix: GetSizeOffersResponse) -> list[dict]:
+    rows = []
+    for row in matrix.sizes:
+        cheapest = f"{row.cheapest.price.amount} UAH, {row.cheapest.supplier}" if row.cheapest else None
+        rows.append({
+            "size": row.size,
+            "cheapest": cheapest if row.status == "ok" else "⏳" if row.status == "pending" else "❌",
+            **{seller: row.prices.get(seller) for seller in matrix.sellers},
+        })
+    return rows
 
+@RENDER_SECONDS.timed(view="size_offers")
+def show_size_offers_stream(container: st, product_id: str, location: str) -> None:
+    table = container.empty()
+
+    # sizes are filled in as their offers come back, the opened one is there from the start
+    for matrix in iter_size_offers(product_id=product_id, location=location, sizes=None, debug_mode=debug_mode):
+        table.dataframe(get_size_offers_rows(matrix), hide_index=True)
+
+    if not matrix.sizes:
+        table.write("The product has no size variants")
+
+
+def show():
 
     st.header("Nova Product Search, v0.2.5")
 
     query = st.text_input("Google Query", value="nike air max 1")
     
     location = st.radio("Location", options=list(LOCATION_DESCRIPTION.keys()), horizontal=True)
+    all_locations = st.toggle("Compare all locations")
+
+    get_products_clicked = st.button("Get Products", disabled=not query)
+
+    deep_search = app_settings.deep_search_pages > 1 and not debug_mode
 
-    if st.button("Get Products", disabled=not query):
-        st.session_state["recommended_products"] = get_recommended_products(query=query, location=location, debug_mode=debug_mode)
+    if get_products_clicked:
+        if not all_locations and not deep_search:
+            recommended_products = get_recommended_products(query=query, location=location, debug_mode=debug_mode)
+            set_session_result("recommended_products", recommended_products)
+            st.session_state["recommended_products_query"] = query
+            prefetch_recommended_product_offers(recommended_products)
         # clean offers
-        st.session_state["recommended_product"] = []
+        set_session_result("recommended_product", None)
 
-    recommended_product_expanded = bool(st.session_state["recommended_product"])
-    recommended_products_expanded = bool(st.session_state["recommended_products"]) and not recommended_product_expanded
+    recommended_products: GetProductsResponse | None = get_session_result("recommended_products")
+    recommended_product: GetProductResponse | None = get_session_result("recommended_product")
+
+    recommended_product_expanded = bool(recommended_product)
+    recommended_products_expanded = (
+        (get_products_clicked or bool(recommended_products)) 
+        and not recommended_product_expanded
+    )
     
 
     with st.expander("Recommended products", expanded=recommended_products_expanded):
@@ -236,11 +297,58 @@ def show():
     with st.expander("Recommended product", expanded=recommended_product_expanded):
         recommended_product_container = st.container()
         
-    if st.session_state["recommended_products"]:
-        show_recommended_products(recommended_products_container)
+    if get_products_clicked and all_locations:
+        # rows are drawn as each market answers instead of after the slowest one
+        recommended_products = show_recommended_products_stream(
+            container=recommended_products_container, 
+            query=query, 
+            locations=list(LOCATION_DESCRIPTION.keys())
+        )
+        set_session_result("recommended_products", recommended_products)
+        st.session_state["recommended_products_query"] = query
+        prefetch_recommended_product_offers(recommended_products)
+    elif get_products_clicked and deep_search:
+        # result pages are drawn in page order as soon as each one is in
+        recommended_products = show_recommended_product_pages_stream(
+            container=recommended_products_container, 
+            query=query, 
+            location=location
+        )
+        set_session_result("recommended_products", recommended_products)
+        st.session_state["recommended_products_query"] = query
+        prefetch_recommended_product_offers(recommended_products)
+    elif recommended_products:
+        show_filtered_recommended_products(recommended_products_container, recommended_products)
+
+    if recommended_product:
+        show_recommended_product_offers(recommended_product_container, recommended_product)
+
+        if recommended_product.product.offers and recommended_product_container.button(
+            "Compare sizes", 
+            key=f"sizes_{recommended_product.product.id}"
+        ):
+            show_size_offers_stream(
+                container=recommended_product_container, 
+                product_id=recommended_product.product.id, 
+                location=recommended_product.product.offers[0].location
+            )
 
-    if st.session_state["recommended_product"]:
-        show_recommended_product_offers(recommended_product_container)
+    if recommended_products:
+        # the opened product brings its sellers with shipping and tax
+        ranked_products = recommended_products.products + ([recommended_product.product] if recommended_product else [])
+        with st.expander("Cheapest delivered", expanded=False):
+            show_cheapest_offers(st.container(), ranked_products)
+
+    exchange_rates_staleness = get_exchange_rate_provider().staleness()
+    if exchange_rates_staleness is not None:
+        st.caption(f"Exchange rates updated {exchange_rates_staleness/60:.0f} min ago")
+
+    if "offer_prefetcher" in st.session_state:
+        prefetch_stats = st.session_state["offer_prefetcher"].stats()
+        st.caption(
+            f"Offers prefetch: {prefetch_stats['spent']}/{prefetch_stats['budget']} SERP calls spent, "
+            f"hit rate {prefetch_stats['hit_rate']*100:.0f}%"
+        )
 
     with st.expander("API payload examples v1", expanded=False):
         st.write("### getProducts")
@@ -252,4 +360,8 @@ def show():
         st.write(get_recommended_product(product_id="", location="us", debug_mode=True).model_dump(mode="json"))
 
 if __name__ == "__main__":
-    show()
\ No newline at end of file
+    if app_settings.metrics_port:
+        start_metrics_server(host=app_settings.metrics_host, port=app_settings.metrics_port)
+
+    with RENDER_SECONDS.time(view="page"), profile_if_slow("streamlit_page"):
+        show()
\ No newline at end of file
@@ -0,0 +1,288 @@
+from typing import Any, Iterator
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from pydantic import BaseModel, ValidationError
+
+from config import app_settings
+from location import LOCATION_DESCRIPTION
+from recommendations import get_recommended_product, get_recommended_products
+from scheduler import Priority, SerpThrottled
+from schemas import GetProductRequest, GetProductsRequest
+
+logger = logging.getLogger(__name__)
+
+# seconds before the first retry of a throttled request, doubled on every next one
+THROTTLED_BACKOFF = 5
+CHECKPOINT_INTERVAL = 1
+PROGRESS_INTERVAL = 30
+
+
+class Checkpoint:
+
+    def __init__(self, path: str, watermark: int = 0, done: set[int] | None = None, offset: int = 0) -> None:
+        self.path = path
+        # every line below the watermark is done, done holds the ones above it finished out of order;
+        # lines are submitted in order, so it never grows past the requests in flight
+        self.watermark = watermark
+        self.done = done or set()
+        # size of the output holding exactly these lines
+        self.offset = offset
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        if not Path(path).exists():
+            return cls(path)
+
+        with open(path, "r") as fp:
+            data = json.load(fp)
+        return cls(path, watermark=data["watermark"], done=set(data["done"]), offset=data["offset"])
+
+    def is_done(self, line: int) -> bool:
+        return line < self.watermark or line in self.done
+
+    def mark_done(self, line: int) -> None:
+        self.done.add(line)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump({"watermark": self.watermark, "done": sorted(self.done), "offset": self.offset}, fp)
+        os.replace(tmp_path, self.path)
+
+
+class BatchSummary:
+
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.ok = 0
+        self.failed = 0
+        self.invalid = 0
+        self.skipped = 0
+        self.errors: dict[str, int] = {}
+        self.stopped: str | None = None
+
+    def add_error(self, error: Exception) -> None:
+        self.failed += 1
+        self.errors[type(error).__name__] = self.errors.get(type(error).__name__, 0) + 1
+
+    def processed(self) -> int:
+        return self.ok + self.failed + self.invalid
+
+    def to_dict(self) -> dict[str, Any]:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "processed": self.processed(),
+            "ok": self.ok,
+            "failed": self.failed,
+            "invalid": self.invalid,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 1),
+            "requests_per_s": round(self.processed()/elapsed, 2) if elapsed else None,
+            "stopped": self.stopped,
+        }
+
+
+def iter_requests(path: str) -> Iterator[tuple[int, str]]:
+    # read lazily, the input can be larger than memory; blank lines are yielded too,
+    # so the checkpoint watermark can move past them
+    fp = sys.stdin if path == "-" else open(path, "r")
+    try:
+        yield from enumerate(fp)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def parse_request(raw: str) -> GetProductsRequest | GetProductRequest:
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError("A request has to be a JSON object")
+
+    request = GetProductRequest.model_validate(data) if "product_id" in data else GetProductsRequest.model_validate(data)
+    if request.location not in LOCATION_DESCRIPTION:
+        raise ValueError(f"Unknown location {request.location}")
+
+    return request
+
+
+def run_request(request: GetProductsRequest | GetProductRequest, retries: int) -> BaseModel:
+    for attempt in range(retries + 1):
+        try:
+            if isinstance(request, GetProductRequest):
+                return get_recommended_product(
+                    product_id=request.product_id,
+                    location=request.location,
+                    debug_mode=app_settings.debug_mode,
+                    priority=Priority.BATCH
+                )
+            return get_recommended_products(
+                query=request.query,
+                location=request.location,
+                debug_mode=app_settings.debug_mode,
+                priority=Priority.BATCH
+            )
+        except SerpThrottled as e:
+            if attempt == retries:
+                raise
+
+            delay = THROTTLED_BACKOFF*2**attempt
+            logger.warning(f"Throttled ({e.reason}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+def format_record(line: int, request: BaseModel | None, response: BaseModel | None = None, error: str | None = None) -> str:
+    # responses are dumped straight to JSON, the record is never built as a dict
+    parts = [f'"line": {line}']
+    if request is not None:
+        parts.append(f'"request": {request.model_dump_json()}')
+    if response is not None:
+        parts.append(f'"response": {response.model_dump_json()}')
+    if error is not None:
+        parts.append(f'"error": {json.dumps(error, ensure_ascii=False)}')
+    return "{" + ", ".join(parts) + "}\n"
+
+
+def run_batch(
+        input_path: str,
+        output_path: str,
+        checkpoint_path: str,
+        workers: int,
+        resume: bool = False,
+        retries: int = 3,
+    ) -> BatchSummary:
+    checkpoint = Checkpoint.load(checkpoint_path) if resume else Checkpoint(checkpoint_path)
+    summary = BatchSummary()
+
+    if resume:
+        logger.info(f"Resuming after line {checkpoint.watermark} with {len(checkpoint.done)} later lines done")
+
+    Path(output_path).touch()
+    if Path(output_path).stat().st_size < checkpoint.offset:
+        raise ValueError(f"{output_path} is shorter than {checkpoint_path} expects, it was not written by that run")
+
+    saved_at = progress_at = time.monotonic()
+    with open(output_path, "r+") as out, ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix="batch"
+    ) as executor:
+        # results written after the last checkpoint are dropped, their lines run again
+        out.truncate(checkpoint.offset)
+        out.seek(checkpoint.offset)
+
+        def save() -> None:
+            out.flush()
+            checkpoint.offset = out.tell()
+            checkpoint.save()
+
+        def finish(line: int, record: str) -> None:
+            nonlocal saved_at
+
+            out.write(record)
+            checkpoint.mark_done(line)
+
+            if time.monotonic() - saved_at >= CHECKPOINT_INTERVAL:
+                save()
+                saved_at = time.monotonic()
+
+        def collect(futures: set[Future], return_when: str) -> set[Future]:
+            nonlocal progress_at
+
+            done, not_done = wait(futures, return_when=return_when)
+            for future in done:
+                line, request = pending.pop(future)
+                try:
+                    response = future.result()
+                except SerpThrottled as e:
+                    # left undone, a later run picks it up
+                    if summary.stopped is None:
+                        logger.warning(f"Stopping, SerpAPI stays throttled ({e.reason}), rerun with --resume")
+                    summary.stopped = f"throttled: {e.reason}"
+                    continue
+                except Exception as e:
+                    logger.warning(f"Line {line} failed: {e!r}")
+                    summary.add_error(e)
+                    finish(line, format_record(line, request, error=repr(e)))
+                else:
+                    summary.ok += 1
+                    finish(line, format_record(line, request, response=response))
+
+            if time.monotonic() - progress_at >= PROGRESS_INTERVAL:
+                progress = summary.to_dict()
+                logger.info(
+                    f"{progress['processed']} requests done, {progress['requests_per_s']}/s, "
+                    f"{progress['failed']} failed, {progress['invalid']} invalid"
+                )
+                progress_at = time.monotonic()
+
+            return not_done
+
+        pending: dict[Future, tuple[int, BaseModel]] = {}
+
+        for line, raw in iter_requests(input_path):
+            if checkpoint.is_done(line):
+                summary.skipped += 1
+                continue
+
+            if not raw.strip():
+                checkpoint.mark_done(line)
+                continue
+
+            try:
+                request = parse_request(raw)
+            except (ValueError, ValidationError) as e:
+                summary.invalid += 1
+                finish(line, format_record(line, None, error=f"Invalid request: {e}"))
+                continue
+
+            pending[executor.submit(run_request, request, retries)] = (line, request)
+
+            # a bounded window, the input is never read further ahead than the workers can take
+            if len(pending) >= workers*2:
+                collect(set(pending), FIRST_COMPLETED)
+            if summary.stopped:
+                break
+
+        collect(set(pending), ALL_COMPLETED)
+        save()
+
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs getProducts/getProduct requests from a JSONL file")
+    parser.add_argument("input", help='JSONL of {"query", "location"} and {"product_id", "location"} requests, - for stdin')
+    parser.add_argument("--output", default="results.jsonl")
+    parser.add_argument("--checkpoint", help="defaults to the output path with .checkpoint appended")
+    parser.add_argument("--resume", action="store_true", help="skip the requests done by an earlier run")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=3, help="retries of a throttled request before stopping")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    summary = run_batch(
+        input_path=args.input,
+        output_path=args.output,
+        checkpoint_path=args.checkpoint or f"{args.output}.checkpoint",
+        workers=args.workers,
+        resume=args.resume,
+        retries=args.retries,
+    )
+
+    logger.info(f"Batch summary: {json.dumps(summary.to_dict())}")
+    sys.exit(1 if summary.stopped else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+from typing import Any, Callable
+from datetime import datetime, timezone
+import argparse
+import copy
+import gc
+import json
+import logging
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from google_client import LOCATION_2_GOOGLE_PARAMS
+from location import get_exchanged_amount, get_exchanged_amounts
+from recommendations import (
+    prepare_recommended_product_offers,
+    prepare_recommended_product_response,
+    prepare_recommended_products,
+)
+from schemas import GoogleShoppingProductsResponse, GoogleShoppingProductResponse
+from serp_replay import generate_product_response, generate_shopping_response
+
+logger = logging.getLogger(__name__)
+
+# fixed so runs on different days are comparable
+BENCH_EXCHANGE_RATES = {"USD": 41.07, "EUR": 44.65, "PLN": 10.38, "GBP": 52.31}
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    idx = max(0, min(len(ordered) - 1, round(pct/100*len(ordered) + 0.5) - 1))
+    return ordered[idx]
+
+
+def measure(fn: Callable[[], Any], items: int, iterations: int) -> dict[str, Any]:
+    fn()
+
+    timings = []
+    for _ in range(iterations):
+        gc.collect()
+        started_at = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started_at)
+
+    # a separate run, tracemalloc slows everything down
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(timings)
+
+    return {
+        "items": items,
+        "iterations": iterations,
+        "mean_ms": round(total/iterations*1000, 4),
+        "p50_ms": round(percentile(timings, 50)*1000, 4),
+        "p99_ms": round(percentile(timings, 99)*1000, 4),
+        "throughput_items_per_s": round(items*iterations/total, 1) if total else None,
+        "peak_memory_kb": round(peak_memory/1024, 1),
+    }
+
+
+def load_datasets(sizes: list[int], location: str) -> list[tuple[str, dict[str, Any], dict[str, Any]]]:
+    with open("./example-shopping-products.json", "r") as fp:
+        products_fixture = json.load(fp)
+    with open("./example-shopping-product.json", "r") as fp:
+        product_fixture = json.load(fp)
+
+    datasets = [("fixture", products_fixture, product_fixture)]
+
+    params = copy.copy(LOCATION_2_GOOGLE_PARAMS[location])
+    for size in sizes:
+        datasets.append((
+            f"synthetic-{size}",
+            generate_shopping_response({**params, "engine": "google_shopping", "q": "nike air max 1"}, n_products=size),
+            generate_product_response({**params, "engine": "google_product", "product_id": "1"}, n_sellers=size),
+        ))
+
+    return datasets
+
+
+def bench_dataset(
+        dataset: str,
+        products_data: dict[str, Any],
+        product_data: dict[str, Any],
+        location: str,
+        iterations: int
+    ) -> list[dict[str, Any]]:
+    results = []
+
+    def add(stage: str, fn: Callable[[], Any], items: int) -> None:
+        result = {"dataset": dataset, "stage": stage, **measure(fn, items=items, iterations=iterations)}
+        logger.info(
+            f"{dataset:>16} {stage:<36} p50 {result['p50_ms']:>10.3f} ms  p99 {result['p99_ms']:>10.3f} ms  "
+            f"{result['throughput_items_per_s'] or 0:>12.0f} items/s  peak {result['peak_memory_kb']:>10.1f} KB"
+        )
+        results.append(result)
+
+    products_raw = json.dumps(products_data).encode("utf-8")
+    product_raw = json.dumps(product_data).encode("utf-8")
+
+    products_response = GoogleShoppingProductsResponse.model_validate_json(products_raw)
+    product_response = GoogleShoppingProductResponse.model_validate_json(product_raw)
+
+    n_products = len(products_response.shopping_results)
+    n_sellers = len(product_response.sellers_results.online_sellers)
+
+    prices = [gp.price for gp in products_response.shopping_results]
+    for gpo in product_response.sellers_results.online_sellers:
+        prices += [gpo.base_price, gpo.total_price]
+        if gpo.additional_price:
+            prices += [gpo.additional_price.shipping, gpo.additional_price.tax]
+
+    # the same path GoogleClient takes, straight from the raw response bytes
+    add("parse_products", lambda: GoogleShoppingProductsResponse.model_validate_json(products_raw), n_products)
+    add("parse_product", lambda: GoogleShoppingProductResponse.model_validate_json(product_raw), n_sellers)
+
+    add(
+        "prepare_recommended_products",
+        lambda: prepare_recommended_products(
+            response=products_response, 
+            location=location, 
+            exchange_rates=BENCH_EXCHANGE_RATES
+        ),
+        n_products
+    )
+    add(
+        "prepare_recommended_product_offers",
+        lambda: prepare_recommended_product_offers(
+            google_product_offers=product_response.sellers_results.online_sellers,
+            location=location,
+            exchange_rates=BENCH_EXCHANGE_RATES
+        ),
+        n_sellers
+    )
+
+    add(
+        "get_exchanged_amount",
+        lambda: [get_exchanged_amount(price=p, location=location, exchange_rates=BENCH_EXCHANGE_RATES) for p in prices],
+        len(prices)
+    )
+    add(
+        "get_exchanged_amounts",
+        lambda: get_exchanged_amounts(prices=prices, location=location, exchange_rates=BENCH_EXCHANGE_RATES),
+        len(prices)
+    )
+
+    products = prepare_recommended_products(
+        response=products_response, 
+        location=location, 
+        exchange_rates=BENCH_EXCHANGE_RATES
+    )
+    product = prepare_recommended_product_response(
+        response=product_response, 
+        location=location, 
+        exchange_rates=BENCH_EXCHANGE_RATES
+    )
+
+    add("dump_products", lambda: products.model_dump(mode="json"), n_products)
+    add("dump_product", lambda: product.model_dump(mode="json"), n_sellers)
+
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results: list[dict[str, Any]], baseline_path: str) -> None:
+    with open(baseline_path, "r") as fp:
+        baseline = {(r["dataset"], r["stage"]): r for r in json.load(fp)["results"]}
+
+    for result in results:
+        base = baseline.get((result["dataset"], result["stage"]))
+        if not base or not base["p50_ms"]:
+            continue
+
+        logger.info(
+            f"{result['dataset']:>16} {result['stage']:<36} p50 x{result['p50_ms']/base['p50_ms']:.2f}  "
+            f"peak memory x{result['peak_memory_kb']/base['peak_memory_kb'] if base['peak_memory_kb'] else 0:.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the search -> transform -> response pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="synthetic products/sellers per response")
+    parser.add_argument("--location", default="us", choices=list(LOCATION_2_GOOGLE_PARAMS.keys()))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="previous results file to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    results = []
+    for dataset, products_data, product_data in load_datasets(sizes=args.sizes, location=args.location):
+        # large responses get fewer rounds, keeping the run time reasonable
+        n_items = len(products_data.get("shopping_results", []))
+        iterations = max(3, min(args.iterations, args.iterations*100 // max(n_items, 1)))
+        results += bench_dataset(dataset, products_data, product_data, location=args.location, iterations=iterations)
+
+    with open(args.output, "w") as fp:
+        json.dump(
+            {
+                "revision": git_revision(),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "location": args.location,
+                "results": results,
+            },
+            fp,
+            indent=2
+        )
+    logger.info(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from typing import Any
+from pathlib import Path
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from config import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_params(params: dict[str, Any]) -> dict[str, Any]:
+    normalized = {}
+
+    for key, value in params.items():
+        if value is None:
+            continue
+
+        if isinstance(value, str):
+            value = " ".join(value.split())
+            # queries differing only by case return the same results
+            if key == "q":
+                value = value.lower()
+
+        normalized[key.lower()] = value
+
+    return dict(sorted(normalized.items()))
+
+
+class ResponseCache:
+
+    def __init__(self, path: str, ttls: dict[str, int], max_entries: int) -> None:
+        self.path = path
+        self.ttls = ttls
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                engine TEXT NOT NULL,
+                location TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                payload BLOB NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    @staticmethod
+    def make_key(engine: str, location: str, params: dict[str, Any]) -> str:
+        raw_key = json.dumps([engine, location, normalize_params(params)], ensure_ascii=False, default=str)
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(self, engine: str, location: str, params: dict[str, Any], allow_stale: bool = False) -> bytes | None:
+        key = self.make_key(engine=engine, location=location, params=params)
+        now = time.time()
+
+        with self._lock:
+            # expired entries stay until evicted, they are still better than nothing when SerpAPI is out of reach
+            row = self._connection.execute(
+                "SELECT payload FROM responses WHERE key = ? AND expires_at > ?", (key, 0 if allow_stale else now)
+            ).fetchone()
+
+            # stale reads come after a counted miss
+            if not allow_stale:
+                if row is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+            if row is None:
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+
+        return row[0]
+
+    def set(self, engine: str, location: str, params: dict[str, Any], content: bytes) -> None:
+        ttl = self.ttls.get(engine)
+        if not ttl:
+            return
+
+        key = self.make_key(engine=engine, location=location, params=params)
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, engine, location, now, now + ttl, now, content),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        logger.info(f"Evicting {count - self.max_entries} least recently used SERP responses")
+        self._connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            size = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "size": size,
+            "max_entries": self.max_entries,
+        }
+
+
+_response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    global _response_cache
+
+    if not app_settings.serp_cache_enabled:
+        return None
+
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                path=app_settings.serp_cache_path,
+                ttls={
+                    "google_shopping": app_settings.serp_cache_ttl_google_shopping,
+                    "google_product": app_settings.serp_cache_ttl_google_product,
+                },
+                max_entries=app_settings.serp_cache_max_entries,
+            )
+
+    return _response_cache
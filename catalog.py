@@ -0,0 +1,387 @@
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from config import app_settings
+from location import get_exchanged_amounts
+from schemas import (
+    CatalogProduct,
+    GoogleShoppingProduct,
+    GoogleShoppingProductResponse,
+    GoogleShoppingProductsResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+QUERY_TOKEN_PATTERN = re.compile(r"\w+")
+# seconds between prunes of a running catalog, entries live catalog_retention anyway
+PRUNE_INTERVAL = 3600
+
+
+def match_expression(query: str) -> str | None:
+    # every word has to match, quoted so user input never reaches the FTS5 query syntax
+    tokens = QUERY_TOKEN_PATTERN.findall(query.lower())
+    return " ".join(f'"{token}"' for token in tokens) or None
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+class ProductCatalog:
+
+    def __init__(self, path: str, retention: int) -> None:
+        self.path = path
+        self.retention = retention
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # responses are indexed off the request path, one writer keeps the inserts in order
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-writer")
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                product_id TEXT NOT NULL,
+                location TEXT NOT NULL,
+                title TEXT NOT NULL,
+                source TEXT,
+                amount REAL,
+                first_seen_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                payload BLOB NOT NULL,
+                UNIQUE (product_id, location)
+            );
+            CREATE INDEX IF NOT EXISTS products_location_updated_at ON products (location, updated_at);
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                title, source, content='products', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS products_ai AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts (rowid, title, source) VALUES (new.id, new.title, new.source);
+            END;
+            CREATE TRIGGER IF NOT EXISTS products_ad AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, title, source) VALUES ('delete', old.id, old.title, old.source);
+            END;
+            CREATE TRIGGER IF NOT EXISTS products_au AFTER UPDATE ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, title, source) VALUES ('delete', old.id, old.title, old.source);
+                INSERT INTO products_fts (rowid, title, source) VALUES (new.id, new.title, new.source);
+            END;
+
+            CREATE TABLE IF NOT EXISTS product_details (
+                product_id TEXT NOT NULL,
+                location TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (product_id, location)
+            );
+
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT NOT NULL,
+                location TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                filters BLOB NOT NULL,
+                product_ids TEXT NOT NULL,
+                related_product_ids TEXT NOT NULL,
+                PRIMARY KEY (query, location, start)
+            );
+            """
+        )
+        self.prune()
+
+    def add_products(self, products: list[GoogleShoppingProduct], location: str) -> None:
+        products = [gp for gp in products if gp.product_id]
+        if not products:
+            return
+
+        # UAH at the rates of the day the product was seen, close enough for filtering
+        amounts = get_exchanged_amounts(prices=[gp.price for gp in products], location=location).amounts.tolist()
+        now = time.time()
+
+        rows = [
+            (gp.product_id, location, gp.title, gp.source, round(amount, 2), now, now, gp.model_dump_json().encode("utf-8"))
+            for gp, amount in zip(products, amounts)
+        ]
+
+        with self._lock:
+            self._connection.executemany(
+                """
+                INSERT INTO products (product_id, location, title, source, amount, first_seen_at, updated_at, payload)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (product_id, location) DO UPDATE SET
+                    title = excluded.title,
+                    source = excluded.source,
+                    amount = excluded.amount,
+                    updated_at = excluded.updated_at,
+                    payload = excluded.payload
+                """,
+                rows,
+            )
+
+    def add_products_response(
+        self,
+        response: GoogleShoppingProductsResponse,
+        location: str,
+        query: str | None = None,
+        start: int | None = None
+    ) -> None:
+        self.add_products(response.shopping_results + response.related_shopping_results, location=location)
+        if query is None:
+            return
+
+        # the page as SerpAPI ordered it, so the search can be answered again as it was
+        filters = json.dumps([f.model_dump(mode="json") for f in response.filters], ensure_ascii=False)
+        product_ids = json.dumps([gp.product_id for gp in response.shopping_results if gp.product_id])
+        related_product_ids = json.dumps([gp.product_id for gp in response.related_shopping_results if gp.product_id])
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    normalize_query(query),
+                    location,
+                    start or 0,
+                    time.time(),
+                    filters.encode("utf-8"),
+                    product_ids,
+                    related_product_ids,
+                ),
+            )
+
+    def add_response(
+        self,
+        response: GoogleShoppingProductsResponse | GoogleShoppingProductResponse,
+        location: str,
+        query: str | None = None,
+        start: int | None = None
+    ) -> None:
+        if isinstance(response, GoogleShoppingProductsResponse):
+            self.add_products_response(response, location=location, query=query, start=start)
+        else:
+            self.add_product_response(response, location=location)
+
+    def add_response_later(
+        self,
+        response: GoogleShoppingProductsResponse | GoogleShoppingProductResponse,
+        location: str,
+        query: str | None = None,
+        start: int | None = None
+    ) -> None:
+        # the response is shared with the caller, it is only read here
+        def add() -> None:
+            try:
+                self.add_response(response, location=location, query=query, start=start)
+                # long-lived processes prune from the writer, off the request path
+                if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+                    self.prune()
+            except Exception:
+                logger.exception(f"Failed to add a {location} location response to the catalog")
+
+        self._writer.submit(add)
+
+    def add_product_response(self, response: GoogleShoppingProductResponse, location: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO product_details VALUES (?, ?, ?, ?)",
+                (response.product_results.product_id, location, time.time(), response.model_dump_json().encode("utf-8")),
+            )
+
+    def search(
+        self,
+        query: str,
+        location: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        max_age: float | None = None,
+        limit: int = 100,
+        product_ids: list[str] | None = None,
+    ) -> list[CatalogProduct]:
+        expression = match_expression(query)
+        if expression is None:
+            return []
+
+        conditions = ["products_fts MATCH ?"]
+        params: list[Any] = [expression]
+
+        if location is not None:
+            conditions.append("p.location = ?")
+            params.append(location)
+        if product_ids is not None:
+            conditions.append(f"p.product_id IN ({', '.join('?'*len(product_ids))})")
+            params.extend(product_ids)
+        if min_price is not None:
+            conditions.append("p.amount >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append("p.amount <= ?")
+            params.append(max_price)
+        if max_age is not None:
+            conditions.append("p.updated_at >= ?")
+            params.append(time.time() - max_age)
+
+        with self._lock:
+            rows = self._connection.execute(
+                f"""
+                SELECT p.payload, p.location, p.amount, p.updated_at
+                FROM products_fts JOIN products p ON p.id = products_fts.rowid
+                WHERE {" AND ".join(conditions)}
+                ORDER BY bm25(products_fts)
+                LIMIT ?
+                """,
+                params + [limit],
+            ).fetchall()
+
+        return [
+            CatalogProduct(
+                product=GoogleShoppingProduct.model_validate_json(payload),
+                location=product_location,
+                amount=amount,
+                updated_at=datetime.fromtimestamp(updated_at, tz=timezone.utc),
+            )
+            for payload, product_location, amount, updated_at in rows
+        ]
+
+    def get_search_response(
+        self,
+        query: str,
+        location: str,
+        max_age: float | None = None,
+        limit: int | None = None
+    ) -> GoogleShoppingProductsResponse | None:
+        with self._lock:
+            searches = self._connection.execute(
+                """
+                SELECT start, filters, product_ids, related_product_ids FROM searches
+                WHERE query = ? AND location = ? AND updated_at >= ?
+                ORDER BY start
+                """,
+                (normalize_query(query), location, time.time() - max_age if max_age is not None else 0),
+            ).fetchall()
+
+        # only a search seen from its first page is answered
+        if not searches or searches[0][0] != 0:
+            return None
+
+        # pages in order without the products repeated on later ones, as a deep search merges them
+        product_ids = list(dict.fromkeys(pid for _, _, page_ids, _ in searches for pid in json.loads(page_ids)))
+        if limit:
+            product_ids = product_ids[:limit]
+        related_product_ids = json.loads(searches[0][3])
+
+        wanted = list(dict.fromkeys(product_ids + related_product_ids))
+        if not wanted:
+            return None
+
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT product_id, payload FROM products WHERE location = ? AND product_id IN ({', '.join('?'*len(wanted))})",
+                [location] + wanted,
+            ).fetchall()
+        payloads = dict(rows)
+
+        # a product pruned since the search makes it incomplete, SerpAPI answers it instead
+        if any(pid not in payloads for pid in product_ids):
+            return None
+
+        return GoogleShoppingProductsResponse(
+            filters=json.loads(searches[0][1]),
+            shopping_results=[GoogleShoppingProduct.model_validate_json(payloads[pid]) for pid in product_ids],
+            related_shopping_results=[
+                GoogleShoppingProduct.model_validate_json(payloads[pid]) for pid in related_product_ids if pid in payloads
+            ],
+        )
+
+    def get_refined_search_response(
+        self,
+        query: str,
+        location: str,
+        max_age: float | None = None,
+        min_results: int = 1,
+        limit: int = 100
+    ) -> GoogleShoppingProductsResponse | None:
+        query_words = set(normalize_query(query).split())
+
+        with self._lock:
+            searches = self._connection.execute(
+                "SELECT query, product_ids, related_product_ids FROM searches WHERE location = ? AND updated_at >= ?",
+                (location, time.time() - max_age if max_age is not None else 0),
+            ).fetchall()
+
+        # a query with every word of an earlier search ("air max 1 nike men" after "nike air max 1")
+        # is looked up among the products that search found, a broader one is never answered
+        product_ids = list(dict.fromkeys(
+            product_id
+            for search_query, page_ids, related_ids in searches
+            if set(search_query.split()) <= query_words
+            for product_id in json.loads(page_ids) + json.loads(related_ids)
+        ))
+        if not product_ids:
+            return None
+
+        catalog_products = self.search(query, location=location, max_age=max_age, limit=limit, product_ids=product_ids)
+        if len(catalog_products) < min_results:
+            return None
+
+        return GoogleShoppingProductsResponse(shopping_results=[cp.product for cp in catalog_products])
+
+    def get_product_response(
+        self,
+        product_id: str,
+        location: str,
+        max_age: float | None = None
+    ) -> GoogleShoppingProductResponse | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload FROM product_details WHERE product_id = ? AND location = ? AND updated_at >= ?",
+                (product_id, location, time.time() - max_age if max_age is not None else 0),
+            ).fetchone()
+
+        return GoogleShoppingProductResponse.model_validate_json(row[0]) if row else None
+
+    def prune(self) -> None:
+        self._pruned_at = time.monotonic()
+        expired_at = time.time() - self.retention
+
+        with self._lock:
+            deleted = self._connection.execute("DELETE FROM products WHERE updated_at < ?", (expired_at,)).rowcount
+            deleted += self._connection.execute("DELETE FROM product_details WHERE updated_at < ?", (expired_at,)).rowcount
+            deleted += self._connection.execute("DELETE FROM searches WHERE updated_at < ?", (expired_at,)).rowcount
+
+        if deleted:
+            logger.info(f"Pruned {deleted} catalog entries not seen for {self.retention}s")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            products = self._connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            product_details = self._connection.execute("SELECT COUNT(*) FROM product_details").fetchone()[0]
+            searches = self._connection.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+
+        return {"products": products, "product_details": product_details, "searches": searches}
+
+
+_product_catalog: ProductCatalog | None = None
+_product_catalog_lock = threading.Lock()
+
+
+def get_product_catalog() -> ProductCatalog | None:
+    global _product_catalog
+
+    if not app_settings.catalog_enabled:
+        return None
+
+    with _product_catalog_lock:
+        if _product_catalog is None:
+            _product_catalog = ProductCatalog(path=app_settings.catalog_path, retention=app_settings.catalog_retention)
+
+    return _product_catalog
@@ -0,0 +1,120 @@
+import numpy as np
+
+from dedupe import title_shingles
+from schemas import RecommendedProduct
+
+SORT_OPTIONS = ["relevance", "price", "price_desc", "similarity"]
+
+
+class ProductColumns:
+
+    def __init__(self, products: list[RecommendedProduct], query: str | None = None) -> None:
+        # the models stay as they are, the arrays hold what filtering and sorting read, row i is products[i]
+        self.products = products
+
+        self.locations = sorted({p.offers[0].location for p in products if p.offers})
+        self.suppliers = sorted({p.offers[0].supplier or "" for p in products if p.offers})
+        location_idx = {location: idx for idx, location in enumerate(self.locations)}
+        supplier_idx = {supplier: idx for idx, supplier in enumerate(self.suppliers)}
+
+        n = len(products)
+        self.amount = np.full(n, np.nan, dtype=np.float64)
+        self.location = np.full(n, -1, dtype=np.int16)
+        self.supplier = np.full(n, -1, dtype=np.int32)
+        self.has_more_offers = np.zeros(n, dtype=bool)
+
+        for idx, product in enumerate(products):
+            self.has_more_offers[idx] = product.has_more_offers
+            if not product.offers:
+                continue
+
+            offer = product.offers[0]
+            # unparsed prices come as zero, they are unknown rather than free
+            if offer.price.amount:
+                self.amount[idx] = offer.price.amount
+            self.location[idx] = location_idx[offer.location]
+            self.supplier[idx] = supplier_idx[offer.supplier or ""]
+
+        self.similarity = self._similarity(query) if query else np.zeros(n, dtype=np.float32)
+
+    def _similarity(self, query: str) -> np.ndarray:
+        query_shingles = title_shingles(query)
+        if not query_shingles:
+            return np.zeros(len(self.products), dtype=np.float32)
+
+        # share of the query words and word pairs found in the title
+        return np.fromiter(
+            (len(query_shingles & title_shingles(p.title)) / len(query_shingles) for p in self.products),
+            dtype=np.float32,
+            count=len(self.products),
+        )
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def nbytes(self) -> int:
+        # the products are the stored result's own, only the arrays are extra
+        return self.amount.nbytes + self.location.nbytes + self.supplier.nbytes + self.has_more_offers.nbytes + self.similarity.nbytes
+
+    def mask(
+        self,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        locations: list[str] | None = None,
+        suppliers: list[str] | None = None,
+        min_similarity: float | None = None,
+        has_more_offers: bool | None = None,
+    ) -> np.ndarray:
+        mask = np.ones(len(self), dtype=bool)
+
+        # NaN compares false, products without a price drop out of any price filter
+        if min_price is not None:
+            mask &= self.amount >= min_price
+        if max_price is not None:
+            mask &= self.amount <= max_price
+        if locations is not None:
+            mask &= np.isin(self.location, [self.locations.index(l) for l in locations if l in self.locations])
+        if suppliers is not None:
+            mask &= np.isin(self.supplier, [self.suppliers.index(s) for s in suppliers if s in self.suppliers])
+        if min_similarity is not None:
+            mask &= self.similarity >= min_similarity
+        if has_more_offers is not None:
+            mask &= self.has_more_offers == has_more_offers
+
+        return mask
+
+    def sort(self, mask: np.ndarray, by: str = "relevance") -> np.ndarray:
+        indices = np.flatnonzero(mask)
+
+        if by == "price":
+            order = np.argsort(self.amount[indices], kind="stable")
+        elif by == "price_desc":
+            # negated so unknown prices stay last either way
+            order = np.argsort(-self.amount[indices], kind="stable")
+        elif by == "similarity":
+            order = np.argsort(-self.similarity[indices], kind="stable")
+        else:
+            return indices
+
+        return indices[order]
+
+    def price_range(self, mask: np.ndarray | None = None) -> tuple[float, float]:
+        amount = self.amount if mask is None else self.amount[mask]
+        if not np.any(~np.isnan(amount)):
+            return 0.0, 0.0
+        return float(np.nanmin(amount)), float(np.nanmax(amount))
+
+    def location_facets(self, mask: np.ndarray | None = None) -> dict[str, int]:
+        return self._facets(self.location, self.locations, mask)
+
+    def supplier_facets(self, mask: np.ndarray | None = None) -> dict[str, int]:
+        return self._facets(self.supplier, self.suppliers, mask)
+
+    @staticmethod
+    def _facets(codes: np.ndarray, labels: list[str], mask: np.ndarray | None) -> dict[str, int]:
+        codes = codes if mask is None else codes[mask]
+        counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+        return {label: int(count) for label, count in zip(labels, counts) if count}
+
+    def take(self, indices: np.ndarray) -> list[RecommendedProduct]:
+        return [self.products[idx] for idx in indices]
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -7,7 +9,118 @@ class AppSettings(BaseSettings):
     app_server: str
 
     serp_api_key: str
-    max_candidates: str | None = None
+
+    # serve the example-shopping-*.json fixtures instead of calling SerpAPI
+    debug_mode: bool = False
+
+    # also bounds the whole call, a hedged one included
+    serp_api_timeout: float = 20
+    serp_api_connect_timeout: float = 5
+    serp_api_pool_size: int = 10
+    serp_api_max_workers: int = 5
+    serp_api_base_url: str | None = None
+
+    # live, record or replay, see serp_replay.py
+    serp_mode: Literal["live", "record", "replay"] = "live"
+    serp_recordings_dir: str = "recordings"
+    serp_replay_latency: float = 0
+    serp_replay_latency_jitter: float = 0
+    serp_replay_error_rate: float = 0
+    serp_replay_synthetic_results: int = 0
+
+    # outbound pacing, burst calls go through at once and the rest at serp_rate_limit per second
+    serp_rate_limit: float | None = 5
+    serp_rate_burst: int = 5
+    serp_scheduler_timeout: float = 10
+    serp_daily_budget: int | None = None
+    serp_monthly_budget: int | None = None
+    # prefetch and batch calls stop at this share of the budget
+    serp_background_budget_share: float = 0.8
+    serp_usage_path: str = ".cache/serp_usage.sqlite3"
+
+    # a slow call is sent once more after the serp_hedge_quantile latency of recent calls, at most
+    # serp_hedge_max_ratio of calls get a second attempt so the quota spent stays about the same
+    serp_hedge_enabled: bool = True
+    serp_hedge_quantile: float = 0.95
+    serp_hedge_min_samples: int = 20
+    serp_hedge_min_delay: float = 1
+    serp_hedge_max_ratio: float = 0.05
+    # a location failing serp_breaker_failures calls in a row is skipped, cached responses are served
+    # instead, and probed again after serp_breaker_reset_timeout seconds
+    serp_breaker_failures: int = 5
+    serp_breaker_reset_timeout: float = 30
+
+    # landed cost estimates for offers without shipping or tax, UAH and share of the price,
+    # per location as JSON, e.g. RANKING_SHIPPING='{"us": 1500, "pl": 300}'
+    ranking_default_shipping: float = 0
+    ranking_shipping: dict[str, float] = {}
+    ranking_default_tax_rate: float = 0
+    ranking_tax_rates: dict[str, float] = {}
+    ranking_top_k: int = 10
+    # rows drawn after filtering and sorting, the rest stay in the session
+    results_page_size: int = 100
+
+    # deep search fetches up to deep_search_pages result pages side by side and
+    # stops as soon as max_candidates unique products are collected
+    max_candidates: int | None = None
+    # titles with at least this shingle overlap are folded into one product, None turns it off
+    dedupe_title_similarity: float | None = 0.8
+    deep_search_pages: int = 1
+    deep_search_page_size: int = 60
+
+    # size variants of a product are fetched at most this many at a time, each one is a SERP call
+    size_offers_max_workers: int = 4
+
+    api_host: str = "127.0.0.1"
+    api_port: int = 8000
+    api_workers: int = 16
+    api_max_concurrency: int = 32
+    api_queue_timeout: float = 5
+    api_request_timeout: float = 30
+
+    # a standalone /metrics endpoint for the Streamlit process, api.py serves its own
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int | None = None
+    # requests slower than this many seconds get a cProfile dump in profile_dir
+    profile_slow_threshold: float | None = None
+    profile_tracemalloc: bool = False
+    profile_dir: str = ".cache/profiles"
+
+    offers_prefetch_top_n: int = 0
+    offers_prefetch_budget: int = 20
+    offers_prefetch_workers: int = 4
+
+    exchange_rates_refresh_interval: float = 3600
+    exchange_rates_retry_interval: float = 300
+    exchange_rates_timeout: float = 10
+    exchange_rates_snapshot_path: str | None = ".cache/exchange_rates.json"
+
+    # every fetched product is kept in a local full-text index; within catalog_max_age a query searched
+    # again is answered from it without a SerpAPI call, and so is a query adding words to an earlier search
+    # when at least catalog_min_results of that search's products match all of its words
+    catalog_enabled: bool = True
+    catalog_path: str = ".cache/catalog.sqlite3"
+    catalog_max_age: int = 3600
+    catalog_min_results: int = 20
+    catalog_retention: int = 7*24*3600
+
+    # search results are kept once per process and shared by sessions, the cap is on their serialized size
+    result_store_max_bytes: int = 256*1024*1024
+
+    # product images are downloaded once, resized to image_cache_max_size px and kept as WebP
+    image_cache_enabled: bool = True
+    image_cache_dir: str = ".cache/images"
+    image_cache_max_bytes: int = 200*1024*1024
+    image_cache_max_size: int = 256
+    image_cache_quality: int = 80
+    image_cache_workers: int = 8
+    image_cache_timeout: float = 3
+
+    serp_cache_enabled: bool = True
+    serp_cache_path: str = ".cache/serp_responses.sqlite3"
+    serp_cache_ttl_google_shopping: int = 3600
+    serp_cache_ttl_google_product: int = 900
+    serp_cache_max_entries: int = 10000
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
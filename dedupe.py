@@ -0,0 +1,182 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import logging
+import re
+import zlib
+
+import numpy as np
+
+from config import app_settings
+from schemas import RecommendedProduct, RecommendedProductOffer
+
+logger = logging.getLogger(__name__)
+
+# query parameters added by ads and analytics, the same page comes with different ones
+TRACKING_PARAMS = {"srsltid", "gclid", "gclsrc", "dclid", "fbclid", "msclkid", "mc_cid", "mc_eid", "cm_mmc", "_ga"}
+
+# 128 permutations in 16 bands of 8 rows, titles sharing about 70% of their
+# shingles land in a common bucket and only those pairs are compared
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+# templated titles can crowd a bucket, newcomers are compared with its latest members only
+LSH_BUCKET_COMPARISONS = 32
+
+# (a*x + b) mod p on 32-bit hashes stays within uint64
+MINHASH_PRIME = np.uint64(4294967291)
+_minhash_random = np.random.default_rng(20240611)
+MINHASH_A = _minhash_random.integers(1, int(MINHASH_PRIME), size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_random.integers(0, int(MINHASH_PRIME), size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+TITLE_TOKEN_PATTERN = re.compile(r"\w+")
+
+# titles differing only by these are variants of a product, not the same listing
+VARIANT_WORDS = {
+    "black", "white", "grey", "gray", "red", "blue", "green", "yellow", "orange", "pink", "purple", "brown",
+    "beige", "navy", "cream", "gold", "silver", "tan", "olive", "khaki", "burgundy", "ivory", "multicolor",
+    "xxs", "xs", "s", "m", "l", "xl", "xxl", "xxxl", "small", "medium", "large",
+}
+
+
+def canonical_link(link: str | None) -> str | None:
+    if not link:
+        return None
+
+    parts = urlsplit(link.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    )
+
+    # http and https, trailing slashes and fragments point to the same page
+    return f"{host}{parts.path.rstrip('/')}" + (f"?{urlencode(query)}" if query else "")
+
+
+def title_shingles(title: str) -> set[str]:
+    tokens = TITLE_TOKEN_PATTERN.findall(title.lower())
+    return set(tokens) | {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}
+
+
+def minhash_signature(shingles: set[str]) -> np.ndarray | None:
+    if not shingles:
+        return None
+
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((np.outer(hashes, MINHASH_A) + MINHASH_B) % MINHASH_PRIME).min(axis=0)
+
+
+def is_variant_token(token: str) -> bool:
+    return token.isdigit() or token in VARIANT_WORDS
+
+
+def are_variants(a: set[str], b: set[str]) -> bool:
+    # each title has a size or colour word the other lacks, "... 7" and "... 14", "... White" and "... Black"
+    return any(is_variant_token(t) for t in a - b) and any(is_variant_token(t) for t in b - a)
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+class DisjointSet:
+
+    def __init__(self, size: int) -> None:
+        self.parent = list(range(size))
+
+    def find(self, idx: int) -> int:
+        while self.parent[idx] != idx:
+            self.parent[idx] = self.parent[self.parent[idx]]
+            idx = self.parent[idx]
+        return idx
+
+    def union(self, a: int, b: int) -> None:
+        root_a, root_b = self.find(a), self.find(b)
+        # the earlier product stays the root, it represents the group
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def union_exact_keys(products: list[RecommendedProduct], groups: DisjointSet) -> None:
+    first_seen: dict[tuple[str, str], int] = {}
+
+    for idx, product in enumerate(products):
+        keys = [("id", product.id)] + [
+            ("link", link) for link in (canonical_link(o.link) for o in product.offers) if link
+        ]
+        for key in keys:
+            if key in first_seen:
+                groups.union(first_seen[key], idx)
+            else:
+                first_seen[key] = idx
+
+
+def union_similar_titles(products: list[RecommendedProduct], groups: DisjointSet, threshold: float) -> None:
+    shingles = [title_shingles(p.title) for p in products]
+    tokens = [{s for s in title_shingles if " " not in s} for title_shingles in shingles]
+    buckets: dict[tuple[int, bytes], list[int]] = {}
+    # similar titles share several bands, each pair is compared once
+    compared: set[tuple[int, int]] = set()
+
+    for idx, signature in enumerate(minhash_signature(s) for s in shingles):
+        if signature is None:
+            continue
+
+        for band in range(LSH_BANDS):
+            bucket = buckets.setdefault((band, signature[band*LSH_ROWS:(band + 1)*LSH_ROWS].tobytes()), [])
+
+            for other in bucket[-LSH_BUCKET_COMPARISONS:]:
+                if (other, idx) in compared or groups.find(other) == groups.find(idx):
+                    continue
+
+                compared.add((other, idx))
+                if jaccard(shingles[idx], shingles[other]) >= threshold and not are_variants(tokens[idx], tokens[other]):
+                    groups.union(other, idx)
+
+            bucket.append(idx)
+
+
+def fold_offers(products: list[RecommendedProduct]) -> RecommendedProduct:
+    offers: list[RecommendedProductOffer] = []
+    seen_offers = set()
+
+    for product in products:
+        for offer in product.offers:
+            key = (offer.supplier, canonical_link(offer.link), offer.location)
+            if key not in seen_offers:
+                seen_offers.add(key)
+                offers.append(offer)
+
+    images = list(dict.fromkeys(image for p in products for image in p.images or []))
+
+    return products[0].model_copy(
+        update={
+            "offers": offers,
+            "images": images,
+            "has_more_offers": any(p.has_more_offers for p in products),
+        }
+    )
+
+
+def dedupe_products(
+        products: list[RecommendedProduct],
+        title_similarity: float | None = None
+    ) -> list[RecommendedProduct]:
+    title_similarity = title_similarity if title_similarity is not None else app_settings.dedupe_title_similarity
+
+    groups = DisjointSet(len(products))
+    union_exact_keys(products, groups)
+    if title_similarity:
+        union_similar_titles(products, groups, threshold=title_similarity)
+
+    grouped: dict[int, list[RecommendedProduct]] = {}
+    for idx, product in enumerate(products):
+        grouped.setdefault(groups.find(idx), []).append(product)
+
+    if len(grouped) < len(products):
+        logger.info(f"Folded {len(products)} products into {len(grouped)}")
+
+    # roots are the first product of each group, so the original order is kept
+    return [
+        group[0] if len(group) == 1 else fold_offers(group)
+        for _, group in sorted(grouped.items())
+    ]
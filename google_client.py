@@ -1,16 +1,48 @@
-from typing import Any
-from serpapi import Client
+from typing import Any, Iterator, TypeVar
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError, as_completed, wait
+from serpapi import Client, HTTPError
 import copy
+import json
 import logging
+import threading
+import time
+
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
 
 from schemas import (
+    GoogleShoppingProduct,
     GoogleShoppingProductsResponse, 
-    GoogleShoppingProductResponse
+    GoogleShoppingProductResponse,
+    SerpErrorResponse,
 )
+from cache import get_response_cache, normalize_params
+from catalog import get_product_catalog
 from config import app_settings
+from metrics import (
+    SERP_API_ERRORS, 
+    SERP_API_REQUEST_SECONDS, 
+    SERP_API_REQUESTS, 
+    SERP_CACHE_HITS, 
+    SERP_CACHE_MISSES, 
+    SERP_HEDGE_WINS,
+    SERP_HEDGED,
+    SERP_PARSE_SECONDS,
+    SERP_STALE_SERVED,
+)
+from resilience import QueueTimeout, call_hedged, get_circuit_breaker, get_hedge_executor, get_hedge_policy
+from scheduler import Priority, SerpThrottled, get_serp_scheduler
+from serp_replay import RecordingAdapter, ReplayAdapter, SerpRecordings, create_serp_replay
+from singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+ResponseModel = TypeVar("ResponseModel", bound=BaseModel)
+
+# shared by every client in the process, so concurrent sessions asking for
+# the same search wait on one SerpAPI call instead of each making their own
+_in_flight_searches = SingleFlight()
+
 
 LOCATION_2_GOOGLE_PARAMS = {
     "us": {
@@ -45,45 +77,427 @@ LOCATION_2_GOOGLE_PARAMS = {
     },
 }
 
+def create_serp_client() -> Client:
+    client = Client(
+        api_key=app_settings.serp_api_key, 
+        timeout=(app_settings.serp_api_connect_timeout, app_settings.serp_api_timeout),
+    )
+
+    # e.g. a local serp_replay.py stand-in server
+    if app_settings.serp_api_base_url:
+        client.BASE_DOMAIN = app_settings.serp_api_base_url.rstrip("/")
+
+    if app_settings.serp_mode == "replay":
+        adapter = ReplayAdapter(create_serp_replay())
+    elif app_settings.serp_mode == "record":
+        adapter = RecordingAdapter(
+            SerpRecordings(app_settings.serp_recordings_dir),
+            pool_connections=1,
+            pool_maxsize=app_settings.serp_api_pool_size,
+        )
+    else:
+        # keep-alive connections to serpapi.com are reused across calls and threads
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app_settings.serp_api_pool_size,
+        )
+
+    logger.info(f"SERP client in {app_settings.serp_mode} mode")
+    client.session.mount("https://", adapter)
+    client.session.mount("http://", adapter)
+
+    return client
+
+
 class GoogleClient:
 
-    def __init__(self) -> None:
-        self.client = Client(api_key=app_settings.serp_api_key)
+    def __init__(self, client: Client | None = None) -> None:
+        self.client = client or create_serp_client()
 
-    def _search_by_location(self, engine: str, location: str, **kwargs) -> dict[str, Any]:
+    def _search_by_location(
+        self, 
+        engine: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE, 
+        **kwargs
+    ) -> tuple[bytes, bool]:
+        # the content and whether a SerpAPI call was sent for it, rather than served from the cache
 
         params = copy.copy(LOCATION_2_GOOGLE_PARAMS[location])
         params["engine"] = engine
         params.update(kwargs)
 
-        logger.info(f"Calling to SERP {engine} API for {location} location")
+        response_cache = get_response_cache()
+        if response_cache:
+            content = response_cache.get(engine=engine, location=location, params=params)
+            if content is not None:
+                SERP_CACHE_HITS.inc(engine=engine, location=location)
+                logger.info(f"Serving SERP {engine} API response for {location} location from cache")
+                return content, False
+            SERP_CACHE_MISSES.inc(engine=engine, location=location)
 
-        response = self.client.search(**params).as_dict()
-        return response
+        try:
+            content = self._request(engine=engine, location=location, params=params, priority=priority)
+        except SerpThrottled as e:
+            content = response_cache.get(engine=engine, location=location, params=params, allow_stale=True) if response_cache else None
+            if content is None:
+                raise
+
+            SERP_STALE_SERVED.inc(engine=engine, location=location)
+            logger.warning(f"SERP {engine} API is not called ({e.reason}), serving a stale {location} response")
+            return content, False
+
+        # SerpAPI reports empty or failed searches in the body, those are not worth keeping;
+        # the byte scan keeps a second parse off every good response
+        if b'"error"' in content and SerpErrorResponse.model_validate_json(content).error is not None:
+            SERP_API_ERRORS.inc(engine=engine, location=location)
+            return content, True
+
+        if response_cache:
+            response_cache.set(engine=engine, location=location, params=params, content=content)
+
+        return content, True
+
+    def _request(self, engine: str, location: str, params: dict[str, Any], priority: Priority) -> bytes:
+        circuit_breaker = get_circuit_breaker(location)
+        circuit_breaker.before_call()
+
+        scheduler = get_serp_scheduler()
+        scheduler.acquire(priority=priority, timeout=app_settings.serp_scheduler_timeout)
+
+        hedge_policy = get_hedge_policy()
+
+        def send() -> bytes:
+            logger.info(f"Calling to SERP {engine} API for {location} location")
+            SERP_API_REQUESTS.inc(engine=engine, location=location)
+
+            started_at = time.perf_counter()
+            with SERP_API_REQUEST_SECONDS.time(engine=engine, location=location):
+                # raw JSON bytes, validated straight into the response models without building a dict first
+                content = self.client.request("GET", "/search", params=dict(params)).content
+
+            if hedge_policy:
+                hedge_policy.observe(engine, time.perf_counter() - started_at)
+            return content
+
+        def hedge() -> bool:
+            if not hedge_policy.allow_hedge():
+                return False
+            # a second attempt pays like any call, but never waits for a slot
+            try:
+                scheduler.acquire(priority=priority, timeout=0)
+            except SerpThrottled:
+                return False
+
+            SERP_HEDGED.inc(engine=engine, location=location)
+            logger.info(f"SERP {engine} API for {location} location is slow, sending a hedged call")
+            return True
+
+        try:
+            content, hedge_won = call_hedged(
+                send,
+                executor=get_hedge_executor(),
+                timeout=app_settings.serp_api_timeout,
+                delay=hedge_policy.delay(engine) if hedge_policy else None,
+                hedge=hedge,
+            )
+        except HTTPError as e:
+            SERP_API_ERRORS.inc(engine=engine, location=location)
+            # bad requests and keys are ours to fix, the location itself is fine
+            if not 400 <= e.status_code < 500:
+                circuit_breaker.record_failure()
+            if e.status_code != 429:
+                raise
+
+            retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+            scheduler.pause(float(retry_after) if retry_after and retry_after.isdigit() else 60)
+            raise SerpThrottled("rate limited by SerpAPI") from e
+        except QueueTimeout:
+            logger.warning(f"SERP {engine} API call for {location} location waited too long for a worker")
+            raise
+        except Exception:
+            SERP_API_ERRORS.inc(engine=engine, location=location)
+            circuit_breaker.record_failure()
+            raise
+
+        circuit_breaker.record_success()
+        if hedge_won:
+            SERP_HEDGE_WINS.inc(engine=engine, location=location)
+
+        return content
+
+    def _search_model_by_location(
+        self, 
+        response_model: type[ResponseModel], 
+        engine: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE, 
+        **kwargs
+    ) -> tuple[ResponseModel, bool]:
+        # the response and whether this caller sent a new SerpAPI call for it,
+        # callers sharing an in-flight search did not
+        key = (engine, location, json.dumps(normalize_params(kwargs), ensure_ascii=False, default=str))
+        searched = False
+
+        def search() -> ResponseModel:
+            nonlocal searched
+
+            content, searched = self._search_by_location(engine=engine, location=location, priority=priority, **kwargs)
+            with SERP_PARSE_SECONDS.time(engine=engine):
+                response = response_model.model_validate_json(content)
+
+            product_catalog = get_product_catalog()
+            if searched and product_catalog:
+                product_catalog.add_response_later(response, location=location, query=kwargs.get("q"), start=kwargs.get("start"))
+
+            return response
 
-    def get_products(self, query: str, location: str) -> GoogleShoppingProductsResponse:
+        response = _in_flight_searches.do(key, search)
+        return response, searched
+
+    def get_products(
+        self, 
+        query: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE,
+        start: int | None = None
+    ) -> GoogleShoppingProductsResponse:
         logger.info("Calling to SERP Shopping API")
-        return GoogleShoppingProductsResponse(
-            **self._search_by_location(engine="google_shopping", location=location, q=query)
+        response, _ = self._search_model_by_location(
+            GoogleShoppingProductsResponse, 
+            engine="google_shopping", 
+            location=location, 
+            priority=priority, 
+            q=query, 
+            start=start
         )
+        return response
+
+    def iter_product_pages(
+        self,
+        query: str,
+        location: str,
+        pages: int | None = None,
+        max_candidates: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        timeout: float | None = None,
+    ) -> Iterator[tuple[int, GoogleShoppingProductsResponse]]:
+        pages = pages or app_settings.deep_search_pages
+        max_candidates = max_candidates or app_settings.max_candidates
+        timeout = timeout or app_settings.serp_api_timeout
+
+        logger.info(f"Calling to SERP Shopping API for {pages} pages of {location} location")
+
+        workers = min(pages, app_settings.serp_api_max_workers)
+        page_size = app_settings.deep_search_page_size
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="serp-pages")
+        deadline = time.monotonic() + timeout
+
+        futures: dict[Future, int] = {}
+        # pages that answered before the ones ahead of them, None for a failed one
+        arrived: dict[int, GoogleShoppingProductsResponse | None] = {}
+        submitted = merged = 0
+        seen = set()
+
+        def submit_needed() -> None:
+            nonlocal submitted
+
+            # a page is only asked for while the pages already asked for may fall short of max_candidates
+            while submitted < pages and len(futures) < workers and (
+                not max_candidates or len(seen) + (submitted - merged)*page_size < max_candidates
+            ):
+                futures[executor.submit(
+                    self.get_products,
+                    query=query,
+                    location=location,
+                    priority=priority,
+                    start=submitted*page_size or None
+                )] = submitted
+                submitted += 1
+
+        def take_candidates(products: list[GoogleShoppingProduct]) -> list[GoogleShoppingProduct]:
+            taken = []
+            for gp in products:
+                if max_candidates and len(seen) >= max_candidates:
+                    break
 
-        # products = response.shopping_results 
-        # # + response.related_shopping_results
-        # # TODO Dedupe
+                key = gp.product_id or gp.link or gp.title
+                if key not in seen:
+                    seen.add(key)
+                    taken.append(gp)
+            return taken
 
-        # logger.info(f"Got {len(products)} prodcuts from SERP shopping API")
-        # if app_settings.max_candidates:
-        #     logger.info(f"Reducing candidates to max {app_settings.max_candidates}")
-        #     products = products[:app_settings.max_candidates]
+        # pages are merged in page order, each yields only the products not seen on earlier ones,
+        # so the max_candidates cut is the same whichever page answers first
+        try:
+            submit_needed()
+            while merged < submitted:
+                if merged not in arrived:
+                    done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                    if not done:
+                        raise TimeoutError()
 
-        # return products
+                    for future in done:
+                        page = futures.pop(future)
+                        try:
+                            arrived[page] = future.result()
+                        except Exception:
+                            logger.exception(f"SERP Shopping API page {page + 1} for {location} location failed")
+                            arrived[page] = None
+                    continue
+
+                page, response = merged, arrived.pop(merged)
+                merged += 1
+                if response is not None:
+                    # every page repeats the related results, only the first one keeps them
+                    yield page, response.model_copy(update={
+                        "shopping_results": take_candidates(response.shopping_results),
+                        "related_shopping_results": take_candidates(response.related_shopping_results) if page == 0 else [],
+                    })
+
+                if max_candidates and len(seen) >= max_candidates:
+                    logger.info(f"Collected {len(seen)} candidates, dropping {submitted - merged} outstanding pages")
+                    break
+
+                submit_needed()
+        except TimeoutError:
+            logger.warning(f"SERP Shopping API pages for {location} location timed out after {timeout}s")
+        finally:
+            # queued pages are dropped, the ones already running finish into the response cache
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def deep_search_products(
+        self,
+        query: str,
+        location: str,
+        pages: int | None = None,
+        max_candidates: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> GoogleShoppingProductsResponse:
+        responses = dict(
+            self.iter_product_pages(
+                query=query, 
+                location=location, 
+                pages=pages, 
+                max_candidates=max_candidates, 
+                priority=priority
+            )
+        )
+        if not responses:
+            raise RuntimeError(f"SERP Shopping API returned no pages for {location} location")
+
+        # back in page order, the first page carries the filters and related results
+        pages_in_order = [responses[page] for page in sorted(responses)]
+
+        return pages_in_order[0].model_copy(
+            update={"shopping_results": [gp for response in pages_in_order for gp in response.shopping_results]}
+        )
 
-    def get_product(self, product_id: str, location: str) -> GoogleShoppingProductResponse:
+    def search_products(
+        self, 
+        query: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> GoogleShoppingProductsResponse:
+        if app_settings.deep_search_pages > 1 or app_settings.max_candidates:
+            return self.deep_search_products(query=query, location=location, priority=priority)
+        return self.get_products(query=query, location=location, priority=priority)
+
+    def get_product(
+        self, 
+        product_id: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> GoogleShoppingProductResponse:
+        response, _ = self.fetch_product(product_id=product_id, location=location, priority=priority)
+        return response
+
+    def fetch_product(
+        self, 
+        product_id: str, 
+        location: str, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> tuple[GoogleShoppingProductResponse, bool]:
+        # the response and whether a SerpAPI call was spent on it
         logger.info("Calling to SERP Shopping Product API")
-        return GoogleShoppingProductResponse(
-            **self._search_by_location(engine="google_product", location=location, product_id=product_id)
+        return self._search_model_by_location(
+            GoogleShoppingProductResponse, 
+            engine="google_product", 
+            location=location, 
+            priority=priority, 
+            product_id=product_id
         )
 
         # return response.sellers_results.online_sellers
 
+    def iter_products_by_locations(
+        self,
+        query: str,
+        locations: list[str] | None = None,
+        timeout: float | None = None,
+    ) -> Iterator[tuple[str, GoogleShoppingProductsResponse | None]]:
+        locations = locations or list(LOCATION_2_GOOGLE_PARAMS.keys())
+        timeout = timeout or app_settings.serp_api_timeout
+
+        logger.info(f"Calling to SERP Shopping API for {len(locations)} locations")
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(len(locations), app_settings.serp_api_max_workers),
+            thread_name_prefix="serp-fan-out",
+        )
+        futures = {
+            executor.submit(self.search_products, query=query, location=location): location
+            for location in locations
+        }
+        pending = set(futures.values())
+
+        # locations run side by side, so a single deadline bounds each of them;
+        # with fewer workers than locations the queued ones share what is left
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                location = futures[future]
+                pending.discard(location)
+
+                try:
+                    yield location, future.result()
+                except Exception:
+                    logger.exception(f"SERP Shopping API for {location} location failed")
+                    yield location, None
+        except TimeoutError:
+            for location in locations:
+                if location in pending:
+                    logger.warning(f"SERP Shopping API for {location} location timed out after {timeout}s")
+                    yield location, None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_products_by_locations(
+        self,
+        query: str,
+        locations: list[str] | None = None,
+        timeout: float | None = None,
+    ) -> dict[str, GoogleShoppingProductsResponse]:
+        locations = locations or list(LOCATION_2_GOOGLE_PARAMS.keys())
+
+        responses = {
+            location: response
+            for location, response in self.iter_products_by_locations(query=query, locations=locations, timeout=timeout)
+            if response is not None
+        }
+
+        # keep the requested location order
+        return {location: responses[location] for location in locations if location in responses}
+
+
+_google_client: GoogleClient | None = None
+_google_client_lock = threading.Lock()
+
+
+def get_google_client() -> GoogleClient:
+    global _google_client
+
+    with _google_client_lock:
+        if _google_client is None:
+            _google_client = GoogleClient()
 
+    return _google_client
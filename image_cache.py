@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+import hashlib
+import logging
+import os
+import threading
+
+from PIL import Image
+from requests.adapters import HTTPAdapter
+import requests
+
+from config import app_settings
+from metrics import IMAGE_CACHE_HITS, IMAGE_CACHE_MISSES, IMAGE_FETCH_SECONDS
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        max_size: int,
+        quality: int,
+        workers: int,
+        timeout: float,
+    ) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.quality = quality
+        self.timeout = timeout
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_maxsize=workers))
+        self._session.mount("http://", HTTPAdapter(pool_maxsize=workers))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-fetch")
+        self._in_flight = SingleFlight()
+
+        self._lock = threading.Lock()
+        # path -> size, least recently used first
+        self._entries: OrderedDict[Path, int] = OrderedDict()
+        self._total_bytes = 0
+        self._load_entries()
+
+    def _load_entries(self) -> None:
+        # files are touched on every hit, so modification time orders them by last use
+        files = sorted(self.directory.glob("*/*.webp"), key=lambda path: path.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._entries[path] = size
+            self._total_bytes += size
+
+    def path(self, url: str) -> Path:
+        key = hashlib.sha256(f"{url}|{self.max_size}|{self.quality}".encode("utf-8")).hexdigest()
+        return self.directory / key[:2] / f"{key}.webp"
+
+    def get(self, url: str) -> Path | None:
+        path = self.path(url)
+
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # removed by another process sharing the directory
+            with self._lock:
+                self._total_bytes -= self._entries.pop(path, 0)
+            return None
+
+        return path
+
+    def fetch(self, url: str) -> Path | None:
+        path = self.get(url)
+        if path is not None:
+            IMAGE_CACHE_HITS.inc()
+            return path
+
+        IMAGE_CACHE_MISSES.inc()
+        return self._in_flight.do(url, self._fetch, url, retry_on_error=False)
+
+    def _fetch(self, url: str) -> Path:
+        with IMAGE_FETCH_SECONDS.time():
+            response = self._session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+
+        image = Image.open(BytesIO(response.content))
+        image.thumbnail((self.max_size, self.max_size))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+        path = self.path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(".tmp")
+        image.save(tmp_path, format="WEBP", quality=self.quality)
+        tmp_path.replace(path)
+
+        self._add(path, path.stat().st_size)
+        return path
+
+    def _add(self, path: Path, size: int) -> None:
+        evicted = []
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_path)
+
+        for old_path in evicted:
+            old_path.unlink(missing_ok=True)
+
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} least recently used images")
+
+    def fetch_many(self, urls: list[str | None], timeout: float | None = None) -> dict[str, Path]:
+        unique_urls = list(dict.fromkeys(url for url in urls if url))
+        paths = {}
+
+        missing = []
+        for url in unique_urls:
+            path = self.get(url)
+            if path is not None:
+                IMAGE_CACHE_HITS.inc()
+                paths[url] = path
+            else:
+                missing.append(url)
+
+        if not missing:
+            return paths
+
+        futures = {self._executor.submit(self.fetch, url): url for url in missing}
+        # images still loading after the timeout are left to the browser, they are cached for the next render;
+        # a zero timeout only returns the local copies and warms the cache in the background
+        done, _ = wait(futures, timeout=timeout if timeout is not None else self.timeout)
+
+        for future in done:
+            try:
+                paths[futures[future]] = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to cache image {futures[future]}: {e}")
+
+        return paths
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"images": len(self._entries), "bytes": self._total_bytes, "max_bytes": self.max_bytes}
+
+
+_image_cache: ImageCache | None = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> ImageCache | None:
+    global _image_cache
+
+    if not app_settings.image_cache_enabled:
+        return None
+
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(
+                directory=app_settings.image_cache_dir,
+                max_bytes=app_settings.image_cache_max_bytes,
+                max_size=app_settings.image_cache_max_size,
+                quality=app_settings.image_cache_quality,
+                workers=app_settings.image_cache_workers,
+                timeout=app_settings.image_cache_timeout,
+            )
+
+    return _image_cache
@@ -1,12 +1,31 @@
-from typing import Any
+from typing import Any, Callable, Mapping
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+import json
+import logging
+import os
+import re
+import threading
+import time
+import numpy as np
 import requests
-import streamlit as st
-from datetime import date
+from datetime import date, datetime, timezone
 from pydantic import BaseModel
 from price_parser import parse_price, Price
 
+from config import app_settings
+from metrics import (
+    EXCHANGE_RATES_FETCH_ERRORS, 
+    EXCHANGE_RATES_FETCH_SECONDS, 
+    PRICE_CONVERSION_PRICES, 
+    PRICE_CONVERSION_SECONDS, 
+    REGISTRY,
+)
 from schemas import ExchangedAmount
 
+logger = logging.getLogger(__name__)
+
 CURRENCY_UAH = "UAH"
 CURRENCY_EUR = "EUR"
 CURRENCY_USD = "USD"
@@ -53,6 +72,21 @@ REPR_CURRENCY = {
     "dollars": "USD"
 }
 
+# all currency representations in one pass, earlier REPR_CURRENCY entries win
+REPR_CURRENCY_PATTERN = re.compile("|".join(re.escape(repr) for repr in REPR_CURRENCY))
+REPR_CURRENCY_PRIORITY = {repr: idx for idx, repr in enumerate(REPR_CURRENCY)}
+
+# the formats SerpAPI returns, e.g. "$86.97", "1 299,00 zł", "€120,00", "1.299,00 €";
+# anything else goes through price_parser
+PRICE_PATTERN = re.compile(
+    r"^\s*(?P<prefix>[$€£₴]|zł)?\s*"
+    r"(?P<integer>\d{1,3}(?:(?P<group_separator>[ \u00a0\u202f,.])\d{3})(?:(?P=group_separator)\d{3})*|\d+)"
+    r"(?:(?P<decimal_separator>[.,])(?P<fraction>\d{1,2}))?"
+    r"\s*(?P<suffix>[$€£₴]|zł|грн)?\s*$"
+)
+
+PRICE_CACHE_SIZE = 8192
+
 
 class MonoExchangeRate(BaseModel):
     currencyCodeA: int
@@ -62,11 +96,14 @@ class MonoExchangeRate(BaseModel):
     rateCross: float | None = None
 
 
-@st.cache_data
-def get_exchange_rates(date: date) -> dict[str, float]:
-    print("Connecting to Monobank")
+MONOBANK_CURRENCY_URL = "https://api.monobank.ua/bank/currency"
+
 
-    r = requests.get("https://api.monobank.ua/bank/currency")
+def fetch_exchange_rates() -> dict[str, float]:
+    logger.info("Connecting to Monobank")
+
+    with EXCHANGE_RATES_FETCH_SECONDS.time():
+        r = requests.get(MONOBANK_CURRENCY_URL, timeout=app_settings.exchange_rates_timeout)
 
     r.raise_for_status()
 
@@ -86,20 +123,207 @@ def get_exchange_rates(date: date) -> dict[str, float]:
 
     return exchange_rates
 
+
+class ExchangeRatesSnapshot(BaseModel):
+    rates: dict[str, float]
+    fetched_at: datetime
+
+
+class ExchangeRateProvider:
+
+    def __init__(
+        self, 
+        fetch: Callable[[], dict[str, float]], 
+        snapshot_path: str | None, 
+        refresh_interval: float,
+        retry_interval: float,
+    ) -> None:
+        self.fetch = fetch
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+
+        # replaced as a whole on refresh, readers never see a half updated table
+        self._rates: Mapping[str, float] | None = None
+        self._fetched_at: datetime | None = None
+
+        self._refresh_lock = threading.Lock()
+        # monotonic time the last fetch finished, successful or not
+        self._attempted_at = 0.0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self.load_snapshot()
+
+        self._thread = threading.Thread(target=self._run, name="exchange-rates-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        # a snapshot loaded from disk is used right away and refreshed when it is due
+        wait = 0.0
+        if self._fetched_at is not None:
+            wait = max(0.0, self.refresh_interval - self.staleness())
+
+        while not self._stopped.wait(wait):
+            wait = self.refresh_interval if self.refresh() else self.retry_interval
+
+    def refresh(self) -> bool:
+        requested_at = time.monotonic()
+
+        with self._refresh_lock:
+            # another thread fetched while this one waited for the lock, Monobank allows about one call a minute
+            if self._attempted_at > requested_at:
+                return self._rates is not None
+
+            try:
+                rates = self.fetch()
+            except Exception:
+                EXCHANGE_RATES_FETCH_ERRORS.inc()
+                logger.exception("Exchange rates refresh failed, keeping the last good rates")
+                return False
+            finally:
+                self._attempted_at = time.monotonic()
+
+            if not rates:
+                logger.warning("Exchange rates refresh returned no rates, keeping the last good rates")
+                return False
+
+            self._swap(ExchangeRatesSnapshot(rates=rates, fetched_at=datetime.now(timezone.utc)))
+            self.save_snapshot()
+
+        return True
+
+    def _swap(self, snapshot: ExchangeRatesSnapshot) -> None:
+        self._rates = MappingProxyType(dict(snapshot.rates))
+        self._fetched_at = snapshot.fetched_at
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+
+        try:
+            with open(self.snapshot_path, "r") as fp:
+                snapshot = ExchangeRatesSnapshot(**json.load(fp))
+        except Exception:
+            logger.exception(f"Could not load exchange rates snapshot {self.snapshot_path}")
+            return False
+
+        self._swap(snapshot)
+        logger.info(f"Loaded exchange rates snapshot from {snapshot.fetched_at.isoformat()}")
+        return True
+
+    def save_snapshot(self) -> None:
+        if not self.snapshot_path or self._rates is None:
+            return
+
+        snapshot = ExchangeRatesSnapshot(rates=dict(self._rates), fetched_at=self._fetched_at)
+
+        Path(self.snapshot_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(snapshot.model_dump_json())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def get_rates(self) -> Mapping[str, float]:
+        rates = self._rates
+
+        # nothing on disk and the refresher has not finished yet
+        if rates is None:
+            self.refresh()
+            rates = self._rates
+
+        if rates is None:
+            raise RuntimeError("No exchange rates available")
+
+        return rates
+
+    def staleness(self) -> float | None:
+        if self._fetched_at is None:
+            return None
+
+        return (datetime.now(timezone.utc) - self._fetched_at).total_seconds()
+
+
+_exchange_rate_provider: ExchangeRateProvider | None = None
+_exchange_rate_provider_lock = threading.Lock()
+
+
+def get_exchange_rate_provider() -> ExchangeRateProvider:
+    global _exchange_rate_provider
+
+    with _exchange_rate_provider_lock:
+        if _exchange_rate_provider is None:
+            _exchange_rate_provider = ExchangeRateProvider(
+                fetch=fetch_exchange_rates,
+                snapshot_path=app_settings.exchange_rates_snapshot_path,
+                refresh_interval=app_settings.exchange_rates_refresh_interval,
+                retry_interval=app_settings.exchange_rates_retry_interval,
+            )
+            _exchange_rate_provider.start()
+
+            REGISTRY.gauge(
+                "exchange_rates_staleness_seconds", 
+                "Age of the exchange rates in use", 
+                function=_exchange_rate_provider.staleness
+            )
+
+    return _exchange_rate_provider
+
+
+def get_exchange_rates(date: date | None = None) -> dict[str, float]:
+    return dict(get_exchange_rate_provider().get_rates())
+
+def find_currency(text: str) -> str | None:
+    reprs = REPR_CURRENCY_PATTERN.findall(text)
+
+    if not reprs:
+        return None
+
+    return REPR_CURRENCY[min(reprs, key=REPR_CURRENCY_PRIORITY.__getitem__)]
+
 def get_price_currency(price: str, location:str) -> str:
-    currency = None
+    return find_currency(price) or LOCATION_DEFAULT_CURRENCY[location]
+
+def _parse_price_fast(price: str) -> tuple[float, str | None] | None:
+    match = PRICE_PATTERN.match(price)
+
+    if not match or (match["prefix"] and match["suffix"]):
+        return None
+
+    group_separator = match["group_separator"]
+    if group_separator and group_separator == match["decimal_separator"]:
+        return None
 
-    for repr, cur in REPR_CURRENCY.items():
-        if repr in price:
-            currency = cur
-            break
+    amount = match["integer"]
+    if group_separator:
+        amount = amount.replace(group_separator, "")
+    if match["fraction"]:
+        amount = f"{amount}.{match['fraction']}"
 
-    if not currency:
-        currency = LOCATION_DEFAULT_CURRENCY[location]
+    return float(amount), match["prefix"] or match["suffix"]
 
-    return currency
+@lru_cache(maxsize=PRICE_CACHE_SIZE)
+def parse_price_amount(price: str) -> tuple[float | None, str | None]:
+    parsed = _parse_price_fast(price)
 
-def get_exchanged_amount(price: str, location:str,  exchange_rates: dict[str, float]) -> ExchangedAmount:
+    if parsed:
+        amount, currency = parsed
+    else:
+        parsed_price: Price = parse_price(price=price)
+        amount = float(parsed_price.amount) if parsed_price.amount is not None else None
+        currency = parsed_price.currency
+
+    return amount, find_currency(currency.lower()) if currency else None
+
+def get_exchanged_amount(price: str, location:str,  exchange_rates: Mapping[str, float] | None = None) -> ExchangedAmount:
+    exchange_rates = exchange_rates if exchange_rates is not None else get_exchange_rate_provider().get_rates()
 
     exchanged_amount = ExchangedAmount(
         amount=0,
@@ -111,21 +335,113 @@ def get_exchanged_amount(price: str, location:str,  exchange_rates: dict[str, fl
     if not price:
         return exchanged_amount
     
-    parsed_price: Price = parse_price(price=price)
+    original_amount, original_currency = parse_price_amount(price)
 
-    if parsed_price.amount is None and parsed_price.currency is None:
+    if original_amount is None:
         return exchanged_amount
 
+    if original_currency:
+        exchanged_amount.original_currency = original_currency
 
-    if parsed_price.currency:
-        for repr, iso_cur in REPR_CURRENCY.items():
-            if repr in parsed_price.currency.lower():
-                exchanged_amount.original_currency = iso_cur
-                break
-
-    exchanged_amount.original_amount = float(parsed_price.amount)
+    exchanged_amount.original_amount = original_amount
 
     rate = exchange_rates.get(exchanged_amount.original_currency, 0)
     exchanged_amount.amount = round(exchanged_amount.original_amount*rate, 2)
 
-    return exchanged_amount
\ No newline at end of file
+    return exchanged_amount
+
+
+class ExchangedAmounts:
+
+    def __init__(
+        self, 
+        amounts: np.ndarray, 
+        original_amounts: np.ndarray, 
+        original_currencies: np.ndarray, 
+        currencies: list[str]
+    ) -> None:
+        # amounts are kept unrounded, rounding happens when models are built
+        self.amounts = amounts
+        self.original_amounts = original_amounts
+        # indexes into currencies
+        self.original_currencies = original_currencies
+        self.currencies = currencies
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+    # the fields are built here from plain floats and known currencies, so models skip validation
+    def to_model(self, idx: int) -> ExchangedAmount:
+        return ExchangedAmount.model_construct(
+            amount=round(float(self.amounts[idx]), 2),
+            currency=CURRENCY_UAH,
+            original_amount=float(self.original_amounts[idx]),
+            original_currency=self.currencies[self.original_currencies[idx]]
+        )
+
+    def to_models(self) -> list[ExchangedAmount]:
+        return [
+            ExchangedAmount.model_construct(
+                amount=round(amount, 2),
+                currency=CURRENCY_UAH,
+                original_amount=original_amount,
+                original_currency=self.currencies[currency_idx]
+            )
+            for amount, original_amount, currency_idx in zip(
+                self.amounts.tolist(), 
+                self.original_amounts.tolist(), 
+                self.original_currencies.tolist()
+            )
+        ]
+
+def get_exchanged_amounts(
+        prices: list[str | None], 
+        location:str, 
+        exchange_rates: Mapping[str, float] | None = None
+    ) -> ExchangedAmounts:
+    exchange_rates = exchange_rates if exchange_rates is not None else get_exchange_rate_provider().get_rates()
+
+    with PRICE_CONVERSION_SECONDS.time():
+        exchanged_amounts = _get_exchanged_amounts(prices=prices, location=location, exchange_rates=exchange_rates)
+    PRICE_CONVERSION_PRICES.inc(len(prices))
+
+    return exchanged_amounts
+
+def _get_exchanged_amounts(
+        prices: list[str | None], 
+        location:str, 
+        exchange_rates: Mapping[str, float]
+    ) -> ExchangedAmounts:
+    default_currency = LOCATION_DEFAULT_CURRENCY[location]
+
+    currencies = [default_currency]
+    currency_idx = {default_currency: 0}
+
+    original_amounts = np.zeros(len(prices), dtype=np.float64)
+    original_currencies = np.zeros(len(prices), dtype=np.int16)
+
+    for idx, price in enumerate(prices):
+        if not price:
+            continue
+
+        original_amount, original_currency = parse_price_amount(price)
+
+        if original_amount is None:
+            continue
+
+        original_amounts[idx] = original_amount
+
+        if original_currency:
+            if original_currency not in currency_idx:
+                currency_idx[original_currency] = len(currencies)
+                currencies.append(original_currency)
+            original_currencies[idx] = currency_idx[original_currency]
+
+    rates = np.array([exchange_rates.get(currency, 0) for currency in currencies], dtype=np.float64)
+
+    return ExchangedAmounts(
+        amounts=original_amounts*rates[original_currencies],
+        original_amounts=original_amounts,
+        original_currencies=original_currencies,
+        currencies=currencies
+    )
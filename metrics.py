@@ -0,0 +1,290 @@
+from typing import Any, Callable, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import cProfile
+import functools
+import json
+import logging
+import math
+import threading
+import time
+import tracemalloc
+
+from config import app_settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, math.inf)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def format_labels(labels: Labels, extra: dict[str, str] | None = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+
+    escaped = (
+        k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[tuple[str, Labels, dict[str, str], float]]:
+        with self._lock:
+            return [(self.name, labels, {}, value) for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, function: Callable[[], float | None] | None = None) -> None:
+        super().__init__(name=name, help=help)
+        # read when metrics are collected, for values owned by another object
+        self.function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> list[tuple[str, Labels, dict[str, str], float]]:
+        if self.function is None:
+            return super().samples()
+
+        value = self.function()
+        return [] if value is None else [(self.name, (), {}, value)]
+
+
+class Histogram:
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> bucket counts, sum, count
+        self._values: dict[Labels, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0]*len(self.buckets), 0.0, 0)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def timed(self, **labels: str) -> Callable[[Callable], Callable]:
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self) -> list[tuple[str, Labels, dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", labels, {"le": format_value(bound)}, bucket_count))
+                samples.append((f"{self.name}_sum", labels, {}, total))
+                samples.append((f"{self.name}_count", labels, {}, count))
+        return samples
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _register(self, metric_class: type, name: str, help: str, **kwargs) -> Any:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name=name, help=help, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter, name, help)
+
+    def gauge(self, name: str, help: str, function: Callable[[], float | None] | None = None) -> Gauge:
+        return self._register(Gauge, name, help, function=function)
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, extra, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels, extra)} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return {
+            metric.name: [
+                {"name": name, "labels": {**dict(labels), **extra}, "value": value}
+                for name, labels, extra, value in metric.samples()
+            ]
+            for metric in metrics
+        }
+
+
+REGISTRY = MetricsRegistry()
+
+SERP_API_REQUEST_SECONDS = REGISTRY.histogram("serp_api_request_seconds", "SerpAPI call latency per engine and location")
+SERP_API_REQUESTS = REGISTRY.counter("serp_api_requests_total", "SerpAPI calls per engine and location")
+SERP_API_ERRORS = REGISTRY.counter("serp_api_errors_total", "Failed SerpAPI calls per engine and location")
+SERP_CACHE_HITS = REGISTRY.counter("serp_cache_hits_total", "SerpAPI responses served from cache")
+SERP_CACHE_MISSES = REGISTRY.counter("serp_cache_misses_total", "SerpAPI responses not found in cache")
+SERP_PARSE_SECONDS = REGISTRY.histogram("serp_response_parse_seconds", "Pydantic parsing of SerpAPI responses per engine")
+EXCHANGE_RATES_FETCH_SECONDS = REGISTRY.histogram("exchange_rates_fetch_seconds", "Monobank exchange rates fetch latency")
+EXCHANGE_RATES_FETCH_ERRORS = REGISTRY.counter("exchange_rates_fetch_errors_total", "Failed Monobank exchange rates fetches")
+PRICE_CONVERSION_SECONDS = REGISTRY.histogram("price_conversion_seconds", "Batch price parsing and conversion")
+PRICE_CONVERSION_PRICES = REGISTRY.counter("price_conversion_prices_total", "Prices parsed and converted")
+RENDER_SECONDS = REGISTRY.histogram("streamlit_render_seconds", "Streamlit rendering per view")
+SERP_SCHEDULER_WAIT_SECONDS = REGISTRY.histogram("serp_scheduler_wait_seconds", "Wait for a SerpAPI rate limit slot per priority")
+SERP_THROTTLED = REGISTRY.counter("serp_throttled_total", "SerpAPI calls refused by the scheduler per priority and reason")
+SERP_STALE_SERVED = REGISTRY.counter("serp_stale_responses_total", "Expired cached responses served while throttled or the location circuit is open")
+SERP_HEDGED = REGISTRY.counter("serp_hedged_total", "SerpAPI calls sent a second time after a slow first attempt")
+SERP_HEDGE_WINS = REGISTRY.counter("serp_hedge_wins_total", "Hedged SerpAPI calls answered by the second attempt")
+SERP_CIRCUIT_OPEN = REGISTRY.gauge("serp_circuit_open", "1 while SerpAPI calls for a location are skipped")
+SERP_CIRCUIT_REJECTED = REGISTRY.counter("serp_circuit_rejected_total", "SerpAPI calls skipped while the location circuit is open")
+IMAGE_CACHE_HITS = REGISTRY.counter("image_cache_hits_total", "Product images served from the local cache")
+IMAGE_CACHE_MISSES = REGISTRY.counter("image_cache_misses_total", "Product images fetched and resized")
+IMAGE_FETCH_SECONDS = REGISTRY.histogram("image_fetch_seconds", "Product image download latency")
+API_REQUEST_SECONDS = REGISTRY.histogram("api_request_seconds", "HTTP API request latency per endpoint and status")
+
+
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def profile_if_slow(name: str) -> Iterator[None]:
+    threshold = app_settings.profile_slow_threshold
+
+    # one capture at a time, cProfile and tracemalloc are costly and tracemalloc is process-wide
+    if threshold is None or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    trace_memory = app_settings.profile_tracemalloc and not tracemalloc.is_tracing()
+
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        started_at = time.perf_counter()
+        profiler.enable()
+
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - started_at
+
+            if duration >= threshold:
+                save_profile(name=name, duration=duration, profiler=profiler, trace_memory=trace_memory)
+
+            if trace_memory:
+                tracemalloc.stop()
+    finally:
+        _profile_lock.release()
+
+
+def save_profile(name: str, duration: float, profiler: cProfile.Profile, trace_memory: bool) -> None:
+    profile_dir = Path(app_settings.profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    path = profile_dir / f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.prof"
+    profiler.dump_stats(path)
+    logger.warning(f"{name} took {duration:.2f}s, profile saved to {path}")
+
+    if trace_memory:
+        top_stats = tracemalloc.take_snapshot().statistics("lineno")[:10]
+        logger.warning(f"{name} top allocations:\n" + "\n".join(str(stat) for stat in top_stats))
+
+
+_metrics_server: ThreadingHTTPServer | None = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(host: str, port: int) -> None:
+    global _metrics_server
+
+    with _metrics_server_lock:
+        if _metrics_server is not None:
+            return
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+                if self.path == "/metrics":
+                    content = REGISTRY.render_prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    content = json.dumps(REGISTRY.to_dict()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
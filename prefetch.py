@@ -0,0 +1,126 @@
+from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import logging
+import threading
+
+from config import app_settings
+from google_client import get_google_client
+from recommendations import prepare_recommended_product_response
+from result_store import get_result_store
+from scheduler import Priority
+from schemas import GetProductResponse
+
+logger = logging.getLogger(__name__)
+
+
+_prefetch_executor: ThreadPoolExecutor | None = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    global _prefetch_executor
+
+    # one bounded pool for the whole process, sessions only own their budget
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=app_settings.offers_prefetch_workers,
+                thread_name_prefix="offers-prefetch",
+            )
+
+    return _prefetch_executor
+
+
+class OfferPrefetcher:
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        # SerpAPI calls sent, prefetches answered from a cache or a shared search are free
+        self.spent = 0
+        # scheduled and not finished yet, each may still cost a call
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._futures: dict[tuple[str, str], Future] = {}
+
+    def prefetch(self, products: list[tuple[str, str]]) -> int:
+        scheduled = 0
+
+        with self._lock:
+            for product_id, location in products:
+                if (product_id, location) in self._futures:
+                    continue
+
+                if self.spent + self.pending >= self.budget:
+                    logger.info(f"Offers prefetch budget of {self.budget} calls is spent")
+                    break
+
+                self._futures[(product_id, location)] = get_prefetch_executor().submit(
+                    self._prefetch, 
+                    product_id=product_id, 
+                    location=location
+                )
+                self.pending += 1
+                scheduled += 1
+
+        logger.info(f"Prefetching offers for {scheduled} products")
+        return scheduled
+
+    def _prefetch(self, product_id: str, location: str) -> str:
+        searched = False
+        try:
+            response, searched = get_google_client().fetch_product(
+                product_id=product_id, 
+                location=location, 
+                priority=Priority.PREFETCH
+            )
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.spent += searched
+
+        # only the result store key is kept, the result goes when the store evicts it
+        return get_result_store().put(prepare_recommended_product_response(response=response, location=location))
+
+    def get(self, product_id: str, location: str, timeout: float | None = None) -> GetProductResponse | None:
+        with self._lock:
+            future = self._futures.get((product_id, location))
+
+            # a prefetch still queued behind others would only be slower than a call of its own
+            if future is not None and future.cancel():
+                del self._futures[(product_id, location)]
+                self.pending -= 1
+                future = None
+                logger.info(f"Offers prefetch for {product_id} in {location} was still queued, calling directly")
+
+        response = None
+
+        if future is not None:
+            # a prefetch that is still running is closer to done than a new call
+            try:
+                response = get_result_store().get(future.result(timeout=timeout))
+            except TimeoutError:
+                logger.info(f"Offers prefetch for {product_id} in {location} is still running")
+            except Exception:
+                logger.exception(f"Offers prefetch for {product_id} in {location} failed")
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return response
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+
+        return {
+            "budget": self.budget,
+            "spent": self.spent,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
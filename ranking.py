@@ -0,0 +1,88 @@
+from typing import Iterator
+import heapq
+import logging
+
+from pydantic import BaseModel, Field
+
+from config import app_settings
+from schemas import RankedOffer, RecommendedProduct, RecommendedProductOffer
+
+logger = logging.getLogger(__name__)
+
+
+class LandedCostEstimates(BaseModel):
+    # UAH for delivery to Ukraine when an offer has no shipping price
+    default_shipping: float = 0
+    shipping: dict[str, float] = Field(default_factory=dict)
+    # share of the price when an offer has no tax
+    default_tax_rate: float = 0
+    tax_rates: dict[str, float] = Field(default_factory=dict)
+
+    def shipping_for(self, location: str) -> float:
+        return self.shipping.get(location, self.default_shipping)
+
+    def tax_rate_for(self, location: str) -> float:
+        return self.tax_rates.get(location, self.default_tax_rate)
+
+
+def get_landed_cost_estimates() -> LandedCostEstimates:
+    return LandedCostEstimates(
+        default_shipping=app_settings.ranking_default_shipping,
+        shipping=app_settings.ranking_shipping,
+        default_tax_rate=app_settings.ranking_default_tax_rate,
+        tax_rates=app_settings.ranking_tax_rates,
+    )
+
+
+def landed_cost(offer: RecommendedProductOffer, estimates: LandedCostEstimates) -> tuple[float, bool, bool] | None:
+    price = offer.price.amount or (offer.total_price.amount if offer.total_price else None)
+    if not price:
+        return None
+
+    shipping = offer.shipping.amount if offer.shipping else None
+    tax = offer.tax.amount if offer.tax else None
+
+    shipping_estimated = shipping is None
+    tax_estimated = tax is None
+
+    if shipping_estimated:
+        shipping = estimates.shipping_for(offer.location)
+    if tax_estimated:
+        tax = price*estimates.tax_rate_for(offer.location)
+
+    return price + shipping + tax, shipping_estimated, tax_estimated
+
+
+def iter_offers(products: list[RecommendedProduct]) -> Iterator[tuple[RecommendedProduct, RecommendedProductOffer]]:
+    for product in products:
+        for offer in product.offers:
+            yield product, offer
+
+
+def rank_offers(
+        products: list[RecommendedProduct],
+        k: int = 10,
+        estimates: LandedCostEstimates | None = None
+    ) -> list[RankedOffer]:
+    estimates = estimates or get_landed_cost_estimates()
+
+    costs = (
+        (cost, product, offer)
+        for product, offer in iter_offers(products)
+        if (cost := landed_cost(offer, estimates)) is not None
+    )
+
+    # a bounded heap over all offers of all markets, only the k cheapest are ever ordered
+    cheapest = heapq.nsmallest(k, costs, key=lambda item: item[0][0])
+
+    return [
+        RankedOffer(
+            product_id=product.id,
+            title=product.title,
+            offer=offer,
+            landed_cost=round(cost, 2),
+            shipping_estimated=shipping_estimated,
+            tax_estimated=tax_estimated,
+        )
+        for (cost, shipping_estimated, tax_estimated), product, offer in cheapest
+    ]
@@ -0,0 +1,475 @@
+from typing import Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+import itertools
+import logging
+
+from catalog import get_product_catalog
+from config import app_settings
+from dedupe import dedupe_products
+from ranking import rank_offers
+from location import get_exchanged_amount, get_exchanged_amounts
+from google_client import get_google_client
+from scheduler import Priority
+from schemas import (
+    GoogleShoppingProduct, 
+    GoogleShoppingProductsResponse, 
+    GoogleShoppingProductOffer, 
+    GoogleShoppingProductResponse,
+    ExchangedAmount,
+    RecommendedProduct,
+    RecommendedProductOffer,
+    ProductFilter,
+    ProductFilterValue,
+    SizeOffers,
+    GetCheapestOffersResponse,
+    GetSizeOffersResponse,
+    GetProductResponse,
+    GetProductsResponse,
+)
+
+# Google responses to the getProducts/getProduct API, shared by the Streamlit
+# app (app.py) and the HTTP service (api.py). Exchange rates default to the
+# process-wide provider, see location.get_exchange_rate_provider
+
+logger = logging.getLogger(__name__)
+
+def prepare_recommended_product(
+        google_product: GoogleShoppingProduct, 
+        location:str, 
+        price: ExchangedAmount | None = None,
+        exchange_rates: Mapping[str, float] | None = None
+    ) -> RecommendedProduct:
+    offer = RecommendedProductOffer(
+        supplier=google_product.source,
+        link=google_product.link,
+        price=price or get_exchanged_amount(
+            price=google_product.price, 
+            location=location, 
+            exchange_rates=exchange_rates
+        ),
+        location=location
+    )
+
+    return RecommendedProduct(
+        id=google_product.product_id,
+        title=google_product.title,
+        images=[google_product.thumbnail],
+        has_more_offers=google_product.number_of_comparisons is not None,
+        more_offers_text=google_product.number_of_comparisons,
+        # TODO remove from API
+        google_product_link=google_product.product_link,
+        offers=[offer]
+    )
+
+def prepare_recommended_product_offer(
+        google_product_offer: GoogleShoppingProductOffer, 
+        location:str, 
+        amounts: dict[str, ExchangedAmount | None] | None = None,
+        exchange_rates: Mapping[str, float] | None = None
+    ) -> RecommendedProductOffer:
+    # amounts converted in a batch, see prepare_recommended_product_offers
+    if amounts is not None:
+        return RecommendedProductOffer(
+            supplier=google_product_offer.name,
+            is_high_quality=google_product_offer.top_quality_store,
+            link=google_product_offer.link,
+            **amounts,
+            location=location
+        )
+
+    return RecommendedProductOffer(
+        supplier=google_product_offer.name,
+        is_high_quality=google_product_offer.top_quality_store,
+        # TODO parse non-google link
+        link=google_product_offer.link,
+        price=get_exchanged_amount(
+            price=google_product_offer.base_price, 
+            location=location, 
+            exchange_rates=exchange_rates
+        ),
+        # unknown rather than free when SerpAPI leaves them out, see ranking.landed_cost
+        shipping=get_exchanged_amount(
+            price=google_product_offer.additional_price.shipping, 
+            location=location, 
+            exchange_rates=exchange_rates
+        ) if google_product_offer.additional_price and google_product_offer.additional_price.shipping else None,
+        tax=get_exchanged_amount(
+            price=google_product_offer.additional_price.tax, 
+            location=location, 
+            exchange_rates=exchange_rates
+        ) if google_product_offer.additional_price and google_product_offer.additional_price.tax else None,
+        total_price=get_exchanged_amount(
+            price=google_product_offer.total_price, 
+            location=location, 
+            exchange_rates=exchange_rates
+        ),
+        # TODO parse from string
+        # delivery_by=None,
+        location=location
+    )
+
+def prepare_recommended_product_offers(
+        google_product_offers: list[GoogleShoppingProductOffer], 
+        location:str,
+        exchange_rates: Mapping[str, float] | None = None
+    ) -> list[RecommendedProductOffer]:
+    # all prices of a response are parsed and converted in one pass
+    prices = get_exchanged_amounts(
+        prices=[gpo.base_price for gpo in google_product_offers]
+        + [gpo.additional_price.shipping if gpo.additional_price else None for gpo in google_product_offers]
+        + [gpo.additional_price.tax if gpo.additional_price else None for gpo in google_product_offers]
+        + [gpo.total_price for gpo in google_product_offers],
+        location=location,
+        exchange_rates=exchange_rates
+    )
+
+    n = len(google_product_offers)
+    offers = []
+
+    for idx, gpo in enumerate(google_product_offers):
+        amounts = {
+            "price": prices.to_model(idx),
+            "shipping": prices.to_model(n + idx) if gpo.additional_price and gpo.additional_price.shipping else None,
+            "tax": prices.to_model(2*n + idx) if gpo.additional_price and gpo.additional_price.tax else None,
+            "total_price": prices.to_model(3*n + idx),
+        }
+        offers.append(
+            prepare_recommended_product_offer(google_product_offer=gpo, location=location, amounts=amounts)
+        )
+
+    return offers
+
+
+def prepare_recommended_products(
+        response: GoogleShoppingProductsResponse, 
+        location:str, 
+        exchange_rates: Mapping[str, float] | None = None,
+        dedupe: bool = True
+    ) -> GetProductsResponse:
+    # related results repeat some of the shopping results, each product id is kept once
+    google_products: list[GoogleShoppingProduct] = []
+    product_ids = set()
+    for gp in response.shopping_results + response.related_shopping_results:
+        if gp.product_id and gp.product_id not in product_ids:
+            product_ids.add(gp.product_id)
+            google_products.append(gp)
+
+    filters = []
+
+    for google_filter in response.filters:
+        if google_filter.type.lower() == "size":
+            filters.append(
+                ProductFilter(
+                    name="size",
+                    values=[
+                        ProductFilterValue(text=gfo.text or "10", key=gfo.tbs) 
+                        for gfo in google_filter.options
+                    ]
+                )
+            )
+    
+    prices = get_exchanged_amounts(
+        prices=[gp.price for gp in google_products], 
+        location=location, 
+        exchange_rates=exchange_rates
+    ).to_models()
+
+    products = [
+        prepare_recommended_product(google_product=gp, location=location, price=price) 
+        for gp, price in zip(google_products, prices)
+    ]
+
+    return GetProductsResponse(
+        filters=filters,
+        products=dedupe_products(products) if dedupe else products
+    )
+
+def without_drawn(response: GetProductsResponse, drawn: set[tuple[str, str]]) -> GetProductsResponse:
+    # streamed batches skip the rows drawn by earlier ones, a row is keyed by its market and product id
+    products = [p for p in response.products if (p.offers[0].location, p.id) not in drawn]
+    drawn.update((p.offers[0].location, p.id) for p in products)
+    return response.model_copy(update={"products": products})
+
+def merge_recommended_products(responses: list[GetProductsResponse]) -> GetProductsResponse:
+    filters: dict[str, ProductFilter] = {}
+    products = []
+
+    for response in responses:
+        for product_filter in response.filters:
+            if product_filter.name not in filters:
+                filters[product_filter.name] = ProductFilter(name=product_filter.name, values=[])
+
+            merged_filter = filters[product_filter.name]
+            known_keys = {v.key for v in merged_filter.values}
+            merged_filter.values += [v for v in product_filter.values if v.key not in known_keys]
+
+        products += response.products
+
+    # the same product found in several markets keeps one row with the offers of all of them
+    return GetProductsResponse(
+        filters=list(filters.values()),
+        products=dedupe_products(products)
+    )
+
+def get_catalog_products(query:str, location:str) -> GoogleShoppingProductsResponse | None:
+    product_catalog = get_product_catalog()
+    if not product_catalog or not app_settings.catalog_max_age:
+        return None
+
+    response = product_catalog.get_search_response(
+        query=query,
+        location=location,
+        max_age=app_settings.catalog_max_age,
+        limit=app_settings.max_candidates
+    ) or product_catalog.get_refined_search_response(
+        query=query,
+        location=location,
+        max_age=app_settings.catalog_max_age,
+        min_results=app_settings.catalog_min_results,
+        limit=app_settings.max_candidates or 100
+    )
+    if response is None:
+        return None
+
+    logger.info(f"Answering {query!r} for {location} location with {len(response.shopping_results)} catalog products")
+    return response
+
+def get_recommended_products(
+        query:str, 
+        location:str, 
+        debug_mode: bool, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> GetProductsResponse:
+    if debug_mode:
+        with open("./example-shopping-products.json", "rb") as fp:
+            response = GoogleShoppingProductsResponse.model_validate_json(fp.read())
+    else:
+        response = (
+            get_catalog_products(query=query, location=location) 
+            or get_google_client().search_products(query=query, location=location, priority=priority)
+        )
+
+    return prepare_recommended_products(response=response, location=location)
+
+def iter_recommended_product_pages(query:str, location:str, debug_mode: bool) -> Iterator[GetProductsResponse]:
+    if debug_mode:
+        with open("./example-shopping-products.json", "rb") as fp:
+            responses = [GoogleShoppingProductsResponse.model_validate_json(fp.read())]
+    else:
+        # pages in page order, without products already seen on earlier pages
+        responses = (response for _, response in get_google_client().iter_product_pages(query=query, location=location))
+
+    # titles are folded once, when the pages are merged
+    drawn: set[tuple[str, str]] = set()
+    for response in responses:
+        yield without_drawn(prepare_recommended_products(response=response, location=location, dedupe=False), drawn)
+
+def iter_recommended_products(
+        query:str, 
+        locations:list[str], 
+        debug_mode: bool
+    ) -> Iterator[tuple[str, GetProductsResponse | None]]:
+    if debug_mode:
+        with open("./example-shopping-products.json", "rb") as fp:
+            debug_response = GoogleShoppingProductsResponse.model_validate_json(fp.read())
+        responses = ((location, debug_response) for location in locations)
+    else:
+        catalog_responses = {location: get_catalog_products(query=query, location=location) for location in locations}
+        serp_locations = [location for location, response in catalog_responses.items() if response is None]
+
+        # catalog answers first, then markets in the order they answer, None for the ones that fail or time out
+        responses = itertools.chain(
+            ((location, response) for location, response in catalog_responses.items() if response is not None), 
+            get_google_client().iter_products_by_locations(query=query, locations=serp_locations) if serp_locations else []
+        )
+
+    # titles are folded once, when the markets are merged
+    drawn: set[tuple[str, str]] = set()
+    for location, response in responses:
+        if response is None:
+            yield location, None
+        else:
+            yield location, without_drawn(prepare_recommended_products(response=response, location=location, dedupe=False), drawn)
+
+def get_recommended_products_by_locations(query:str, locations:list[str], debug_mode: bool) -> GetProductsResponse:
+    responses = {
+        location: response
+        for location, response in iter_recommended_products(query=query, locations=locations, debug_mode=debug_mode)
+        if response is not None
+    }
+
+    return merge_recommended_products(
+        [responses[location] for location in locations if location in responses]
+    )
+
+def get_cheapest_offers(query:str, locations:list[str], limit:int, debug_mode: bool) -> GetCheapestOffersResponse:
+    response = get_recommended_products_by_locations(query=query, locations=locations, debug_mode=debug_mode)
+    return GetCheapestOffersResponse(offers=rank_offers(response.products, k=limit))
+
+def prepare_recommended_product_response(
+        response: GoogleShoppingProductResponse, 
+        location:str, 
+        exchange_rates: Mapping[str, float] | None = None
+    ) -> GetProductResponse:
+    selected_filters = []
+
+    for size, size_data in response.product_results.sizes.items():
+        if size_data.selected:
+            selected_filters.append(
+                ProductFilter(
+                    name="size",
+                    values=[ProductFilterValue(text=size, key=size_data.product_id, is_selected=True)]
+                )
+            )
+
+    offers = prepare_recommended_product_offers(
+        google_product_offers=response.sellers_results.online_sellers, 
+        location=location,
+        exchange_rates=exchange_rates
+    )
+
+    images = [
+        m.link
+        for m in response.product_results.media
+        if m.type == "image"
+    ]
+
+    return GetProductResponse(
+        selected_filters=selected_filters,
+        product=RecommendedProduct(
+            id=response.product_results.product_id,
+            title=response.product_results.title,
+            images=images,
+            offers=offers,
+        )
+    )
+
+def get_product_response(
+        product_id:str, 
+        location:str, 
+        debug_mode: bool, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> GoogleShoppingProductResponse:
+    if debug_mode:
+        with open("./example-shopping-product.json", "rb") as fp:
+            return GoogleShoppingProductResponse.model_validate_json(fp.read())
+
+    # sellers and prices go stale faster than search results, they are kept no longer than the response cache keeps them
+    max_age = min(app_settings.catalog_max_age, app_settings.serp_cache_ttl_google_product)
+    product_catalog = get_product_catalog()
+    return (
+        product_catalog.get_product_response(
+            product_id=product_id, 
+            location=location, 
+            max_age=max_age
+        ) if product_catalog and max_age else None
+    ) or get_google_client().get_product(product_id=product_id, location=location, priority=priority)
+
+def get_recommended_product(
+        product_id:str, 
+        location:str, 
+        debug_mode: bool, 
+        priority: Priority = Priority.INTERACTIVE
+    ) -> GetProductResponse:
+    response = get_product_response(product_id=product_id, location=location, debug_mode=debug_mode, priority=priority)
+    return prepare_recommended_product_response(response=response, location=location)
+
+def add_size_offers(
+        matrix: GetSizeOffersResponse, 
+        row: SizeOffers, 
+        offers: list[RecommendedProductOffer]
+    ) -> None:
+    for offer in offers:
+        # unparsed prices come as zero, they are unknown rather than free
+        if not offer.price.amount:
+            continue
+
+        seller = offer.supplier or ""
+        if seller not in row.prices:
+            row.prices[seller] = offer.price.amount
+            if seller not in matrix.sellers:
+                matrix.sellers.append(seller)
+        else:
+            row.prices[seller] = min(row.prices[seller], offer.price.amount)
+
+        if row.cheapest is None or offer.price.amount < row.cheapest.price.amount:
+            row.cheapest = offer
+
+    row.status = "ok"
+
+def iter_size_offers(
+        product_id:str, 
+        location:str, 
+        sizes: list[str] | None, 
+        debug_mode: bool,
+        timeout: float | None = None
+    ) -> Iterator[GetSizeOffersResponse]:
+    timeout = timeout or app_settings.serp_api_timeout
+
+    response = get_product_response(product_id=product_id, location=location, debug_mode=debug_mode)
+    product_results = response.product_results
+
+    matrix = GetSizeOffersResponse(
+        product_id=product_results.product_id,
+        title=product_results.title,
+        location=location,
+        sizes=[
+            SizeOffers(size=size, product_id=size_data.product_id)
+            for size, size_data in product_results.sizes.items()
+            if sizes is None or size in sizes
+        ],
+    )
+
+    # the opened size comes with the product, only the other ones cost a call
+    offers = prepare_recommended_product_response(response=response, location=location).product.offers
+    rows = {}
+    for row in matrix.sizes:
+        if row.product_id == product_results.product_id:
+            add_size_offers(matrix, row, offers)
+        else:
+            rows.setdefault(row.product_id, []).append(row)
+
+    # the same matrix is yielded again after every size, filled in place
+    yield matrix
+
+    if not rows:
+        return
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(len(rows), app_settings.size_offers_max_workers), 
+        thread_name_prefix="size-offers"
+    )
+    futures = {
+        executor.submit(get_recommended_product, product_id=size_product_id, location=location, debug_mode=debug_mode): size_product_id
+        for size_product_id in rows
+    }
+
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            size_product_id = futures[future]
+            try:
+                offers = future.result().product.offers
+            except Exception:
+                logger.exception(f"Offers of size variant {size_product_id} in {location} location failed")
+                for row in rows[size_product_id]:
+                    row.status = "failed"
+            else:
+                for row in rows[size_product_id]:
+                    add_size_offers(matrix, row, offers)
+
+            yield matrix
+    except TimeoutError:
+        logger.warning(f"Offers of {product_id} sizes in {location} location timed out after {timeout}s")
+        for row in matrix.sizes:
+            if row.status == "pending":
+                row.status = "failed"
+        yield matrix
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_size_offers(product_id:str, location:str, sizes: list[str] | None, debug_mode: bool) -> GetSizeOffersResponse:
+    for matrix in iter_size_offers(product_id=product_id, location=location, sizes=sizes, debug_mode=debug_mode):
+        pass
+
+    return matrix
+    
@@ -0,0 +1,221 @@
+from typing import Callable, TypeVar
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed, wait
+import logging
+import threading
+import time
+
+from config import app_settings
+from metrics import SERP_CIRCUIT_OPEN, SERP_CIRCUIT_REJECTED
+from scheduler import SerpThrottled
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpen(SerpThrottled):
+    pass
+
+
+# the call never left the process, it says nothing about the location
+class QueueTimeout(TimeoutError):
+    pass
+
+
+class HedgePolicy:
+
+    def __init__(self, quantile: float, min_samples: int, min_delay: float, max_ratio: float, window: int = 200) -> None:
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._latencies: dict[str, deque[float]] = {}
+        self._calls = 0
+        self._hedges = 0
+
+    def observe(self, engine: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(engine, deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, engine: str) -> float | None:
+        with self._lock:
+            self._calls += 1
+            latencies = sorted(self._latencies.get(engine, ()))
+
+        # too few calls to tell the tail from the rest
+        if len(latencies) < self.min_samples:
+            return None
+
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(len(latencies)*self.quantile))])
+
+    def allow_hedge(self) -> bool:
+        # a hedge costs a SerpAPI search, only a small share of calls may send one
+        with self._lock:
+            if self._hedges + 1 > self._calls*self.max_ratio:
+                return False
+            self._hedges += 1
+            return True
+
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probe_until = 0.0
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            now = time.monotonic()
+            # after reset_timeout one call at a time goes through to probe the location,
+            # a probe that never reports back frees its slot after another reset_timeout
+            if now - self._opened_at >= self.reset_timeout and now >= self._probe_until:
+                self._probe_until = now + self.reset_timeout
+                logger.info(f"Probing SerpAPI for {self.name} location")
+                return
+
+        SERP_CIRCUIT_REJECTED.inc(location=self.name)
+        raise CircuitOpen(f"{self.name} location failed {self.failure_threshold} times in a row")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            if self._opened_at is None:
+                return
+            self._opened_at = None
+            self._probe_until = 0.0
+
+        SERP_CIRCUIT_OPEN.set(0, location=self.name)
+        logger.info(f"SerpAPI for {self.name} location recovered, closing the circuit")
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.failure_threshold:
+                return
+
+            # a failed probe keeps it open for another reset_timeout
+            reopened = self._opened_at is not None
+            self._opened_at = time.monotonic()
+            self._probe_until = 0.0
+
+        SERP_CIRCUIT_OPEN.set(1, location=self.name)
+        if not reopened:
+            logger.warning(
+                f"SerpAPI for {self.name} location failed {self._failures} times in a row, "
+                f"skipping it for {self.reset_timeout}s"
+            )
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+
+def call_hedged(
+        call: Callable[[], T],
+        executor: ThreadPoolExecutor,
+        timeout: float,
+        delay: float | None = None,
+        hedge: Callable[[], bool] | None = None,
+    ) -> tuple[T, bool]:
+    started = threading.Event()
+    started_at = 0.0
+
+    def attempt() -> T:
+        nonlocal started_at
+
+        if not started.is_set():
+            started_at = time.monotonic()
+            started.set()
+        return call()
+
+    futures: list[Future] = [executor.submit(attempt)]
+
+    # the deadline and the hedge delay run from the moment a worker picks the call up,
+    # time spent queued behind other calls of this process is not the location's
+    if not started.wait(timeout=timeout):
+        if futures[0].cancel():
+            raise QueueTimeout(f"no free worker in {timeout}s")
+        started.wait()
+
+    if delay is not None and delay < timeout and hedge is not None:
+        done, _ = wait(futures, timeout=max(0.0, started_at + delay - time.monotonic()))
+        if not done and hedge():
+            futures.append(executor.submit(attempt))
+
+    # the first answer wins, a failed attempt still leaves the other one to wait for;
+    # the slower call is not cancelled, it ends on its own read timeout
+    error: Exception | None = None
+    try:
+        for future in as_completed(futures, timeout=max(0.0, started_at + timeout - time.monotonic())):
+            try:
+                return future.result(), future is not futures[0]
+            except Exception as e:
+                error = e
+    except TimeoutError:
+        raise TimeoutError(f"no answer in {timeout}s") from None
+
+    raise error
+
+
+_hedge_policy: HedgePolicy | None = None
+_hedge_executor: ThreadPoolExecutor | None = None
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_resilience_lock = threading.Lock()
+
+
+def get_hedge_policy() -> HedgePolicy | None:
+    global _hedge_policy
+
+    if not app_settings.serp_hedge_enabled:
+        return None
+
+    with _resilience_lock:
+        if _hedge_policy is None:
+            _hedge_policy = HedgePolicy(
+                quantile=app_settings.serp_hedge_quantile,
+                min_samples=app_settings.serp_hedge_min_samples,
+                min_delay=app_settings.serp_hedge_min_delay,
+                max_ratio=app_settings.serp_hedge_max_ratio,
+            )
+
+    return _hedge_policy
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+
+    with _resilience_lock:
+        if _hedge_executor is None:
+            # room for a hedge next to every pooled connection
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=app_settings.serp_api_pool_size*2,
+                thread_name_prefix="serp-call",
+            )
+
+    return _hedge_executor
+
+
+def get_circuit_breaker(location: str) -> CircuitBreaker:
+    with _resilience_lock:
+        if location not in _circuit_breakers:
+            _circuit_breakers[location] = CircuitBreaker(
+                name=location,
+                failure_threshold=app_settings.serp_breaker_failures,
+                reset_timeout=app_settings.serp_breaker_reset_timeout,
+            )
+            SERP_CIRCUIT_OPEN.set(0, location=location)
+
+    return _circuit_breakers[location]
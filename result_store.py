@@ -0,0 +1,166 @@
+from typing import Any, Callable, Hashable
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+
+from pydantic import BaseModel
+
+from config import app_settings
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# filled with the time of parsing rather than read from the response, see
+# RecommendedProductOffer.delivery_by, equal results would never hash the same
+VOLATILE_FIELDS = {"delivery_by"}
+
+
+def strip_volatile_fields(data: Any) -> Any:
+    if isinstance(data, dict):
+        return {k: strip_volatile_fields(v) for k, v in data.items() if k not in VOLATILE_FIELDS}
+    if isinstance(data, list):
+        return [strip_volatile_fields(v) for v in data]
+    return data
+
+
+class ResultStore:
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> (result, serialized size plus its derived values), least recently used first
+        self._entries: OrderedDict[str, tuple[BaseModel, int]] = OrderedDict()
+        # key -> values built from the result, dropped together with it
+        self._derived: dict[str, dict[Hashable, Any]] = {}
+        self._total_bytes = 0
+        self._puts = 0
+        self._shared = 0
+
+    @staticmethod
+    def key(result: BaseModel) -> tuple[str, int]:
+        payload = json.dumps(
+            strip_volatile_fields(result.model_dump(mode="json")),
+            sort_keys=True,
+            separators=(",", ":")
+        ).encode("utf-8")
+        return f"{type(result).__name__}:{hashlib.sha256(payload).hexdigest()}", len(payload)
+
+    def put(self, result: BaseModel) -> str:
+        key, size = self.key(result)
+
+        with self._lock:
+            self._puts += 1
+
+            # sessions that ran the same search share the first copy, the new one is dropped
+            if key in self._entries:
+                self._shared += 1
+                self._entries.move_to_end(key)
+                return key
+
+            self._entries[key] = (result, size)
+            self._total_bytes += size
+            evicted = self._evict()
+
+        if evicted:
+            logger.info(f"Evicted {evicted} least recently used results")
+
+        return key
+
+    def _evict(self) -> int:
+        evicted = 0
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, (_, old_size) = self._entries.popitem(last=False)
+            self._derived.pop(old_key, None)
+            self._total_bytes -= old_size
+            evicted += 1
+        return evicted
+
+    def get(self, key: str) -> BaseModel | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+
+        return entry[0]
+
+    def get_derived(
+        self,
+        key: str,
+        name: Hashable,
+        build: Callable[[BaseModel], Any],
+        size_of: Callable[[Any], int]
+    ) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+
+            derived = self._derived.get(key, {})
+            if name in derived:
+                return derived[name]
+
+        value = build(entry[0])
+        size = size_of(value)
+        evicted = 0
+
+        with self._lock:
+            # a result evicted while building keeps nothing behind
+            if key in self._entries:
+                derived = self._derived.setdefault(key, {})
+                if name in derived:
+                    return derived[name]
+
+                # derived values count against max_bytes as part of their result
+                derived[name] = value
+                result, result_size = self._entries[key]
+                self._entries[key] = (result, result_size + size)
+                self._total_bytes += size
+                evicted = self._evict()
+
+        if evicted:
+            logger.info(f"Evicted {evicted} least recently used results")
+
+        return value
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "results": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "shared_rate": self._shared/self._puts if self._puts else 0.0,
+            }
+
+
+_result_store: ResultStore | None = None
+_result_store_lock = threading.Lock()
+
+
+def get_result_store() -> ResultStore:
+    global _result_store
+
+    with _result_store_lock:
+        if _result_store is None:
+            _result_store = ResultStore(max_bytes=app_settings.result_store_max_bytes)
+
+            REGISTRY.gauge(
+                "result_store_bytes",
+                "Serialized size of the search results shared by sessions",
+                function=_result_store.total_bytes
+            )
+            REGISTRY.gauge(
+                "result_store_results",
+                "Search results shared by sessions",
+                function=lambda: _result_store.stats()["results"]
+            )
+
+    return _result_store
@@ -0,0 +1,220 @@
+from datetime import datetime, timezone
+from enum import IntEnum
+from pathlib import Path
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+from config import app_settings
+from metrics import REGISTRY, SERP_SCHEDULER_WAIT_SECONDS, SERP_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    PREFETCH = 1
+    BATCH = 2
+
+
+class SerpThrottled(Exception):
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def usage_periods(now: datetime | None = None) -> tuple[str, str]:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime("%Y-%m-%d"), now.strftime("%Y-%m")
+
+
+class SerpUsage:
+
+    def __init__(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # shared by the Streamlit and API processes, sqlite keeps the counters consistent between them
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS usage (period TEXT PRIMARY KEY, calls INTEGER NOT NULL)"
+        )
+
+    def get(self, period: str) -> int:
+        with self._lock:
+            row = self._connection.execute("SELECT calls FROM usage WHERE period = ?", (period,)).fetchone()
+        return row[0] if row else 0
+
+    def reserve(self, limits: dict[str, int | None]) -> str | None:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                for period, limit in limits.items():
+                    if limit is None:
+                        continue
+                    row = self._connection.execute("SELECT calls FROM usage WHERE period = ?", (period,)).fetchone()
+                    if (row[0] if row else 0) >= limit:
+                        self._connection.execute("ROLLBACK")
+                        return period
+
+                self._add(list(limits.keys()), 1)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return None
+
+    def refund(self, periods: list[str]) -> None:
+        with self._lock:
+            self._add(periods, -1)
+
+    def _add(self, periods: list[str], calls: int) -> None:
+        self._connection.executemany(
+            "INSERT INTO usage VALUES (?, ?) ON CONFLICT (period) DO UPDATE SET calls = calls + excluded.calls",
+            [(period, calls) for period in periods],
+        )
+
+
+class SerpScheduler:
+
+    def __init__(
+        self,
+        rate: float | None,
+        burst: int,
+        daily_budget: int | None = None,
+        monthly_budget: int | None = None,
+        background_budget_share: float = 1.0,
+        usage: SerpUsage | None = None,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.daily_budget = daily_budget
+        self.monthly_budget = monthly_budget
+        self.background_budget_share = background_budget_share
+        self.usage = usage
+
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        # (priority, arrival), the head of the heap gets the next token
+        self._waiting: list[tuple[int, int]] = []
+        self._arrivals = itertools.count()
+
+    def budget_limits(self, priority: Priority) -> dict[str, int | None]:
+        # background work stops early, the rest of the budget is kept for interactive searches
+        share = 1.0 if priority == Priority.INTERACTIVE else self.background_budget_share
+        day, month = usage_periods()
+
+        return {
+            day: int(self.daily_budget*share) if self.daily_budget is not None else None,
+            month: int(self.monthly_budget*share) if self.monthly_budget is not None else None,
+        }
+
+    def acquire(self, priority: Priority = Priority.INTERACTIVE, timeout: float | None = None) -> None:
+        limits = self.budget_limits(priority)
+
+        if self.usage:
+            exceeded = self.usage.reserve(limits)
+            if exceeded is not None:
+                SERP_THROTTLED.inc(priority=priority.name.lower(), reason="budget")
+                raise SerpThrottled(f"SerpAPI budget for {exceeded} is spent")
+
+        started_at = time.perf_counter()
+        try:
+            self._take_token(priority, timeout)
+        except SerpThrottled:
+            if self.usage:
+                self.usage.refund(list(limits.keys()))
+            SERP_THROTTLED.inc(priority=priority.name.lower(), reason="rate")
+            raise
+        finally:
+            SERP_SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - started_at, priority=priority.name.lower())
+
+    def _take_token(self, priority: Priority, timeout: float | None) -> None:
+        if self.rate is None:
+            return
+
+        ticket = (int(priority), next(self._arrivals))
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated_at)*self.rate)
+                    self._updated_at = now
+
+                    is_next = self._waiting[0] == ticket
+                    if is_next and now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    if deadline is not None and now >= deadline:
+                        raise SerpThrottled(f"waited {timeout}s for a SerpAPI rate limit slot")
+
+                    # only the head sleeps until its token, the rest wait to be woken up
+                    wait = max(self._paused_until - now, (1 - self._tokens)/self.rate) if is_next else None
+                    if deadline is not None:
+                        wait = min(wait, deadline - now) if wait is not None else deadline - now
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self._cond:
+            logger.warning(f"SerpAPI rate limited us, pausing outbound calls for {seconds}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._cond.notify_all()
+
+    def waiting(self) -> int:
+        with self._cond:
+            return len(self._waiting)
+
+
+_serp_scheduler: SerpScheduler | None = None
+_serp_scheduler_lock = threading.Lock()
+
+
+def get_serp_scheduler() -> SerpScheduler:
+    global _serp_scheduler
+
+    with _serp_scheduler_lock:
+        if _serp_scheduler is None:
+            # replayed responses do not cost anything, only the pacing applies
+            usage = SerpUsage(app_settings.serp_usage_path) if app_settings.serp_mode != "replay" else None
+
+            _serp_scheduler = SerpScheduler(
+                rate=app_settings.serp_rate_limit,
+                burst=app_settings.serp_rate_burst,
+                daily_budget=app_settings.serp_daily_budget,
+                monthly_budget=app_settings.serp_monthly_budget,
+                background_budget_share=app_settings.serp_background_budget_share,
+                usage=usage,
+            )
+
+            REGISTRY.gauge("serp_scheduler_waiting", "Calls waiting for a SerpAPI rate limit slot", function=_serp_scheduler.waiting)
+            if usage:
+                REGISTRY.gauge(
+                    "serp_budget_used_daily",
+                    "SerpAPI calls spent today",
+                    function=lambda: usage.get(usage_periods()[0])
+                )
+                REGISTRY.gauge(
+                    "serp_budget_used_monthly",
+                    "SerpAPI calls spent this month",
+                    function=lambda: usage.get(usage_periods()[1])
+                )
+
+    return _serp_scheduler
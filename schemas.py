@@ -1,7 +1,14 @@
 from datetime import datetime
+from typing import Literal
 from pydantic import BaseModel, Field
 
 
+# SerpAPI responses are validated straight from the raw JSON, only the fields
+# we read are declared, the rest of the payload is skipped while parsing
+
+class SerpErrorResponse(BaseModel):
+    error: str | None = None
+
 # Google Products
 
 class GoogleShoppingProduct(BaseModel):
@@ -9,23 +16,12 @@ class GoogleShoppingProduct(BaseModel):
     link: str | None = None
     product_link: str | None = None
     product_id: str | None = None
-    serpapi_product_api: str | None = None
     source: str | None = None
     number_of_comparisons: str | None = None
     
     price: str | None = None
-    extracted_price: float | None = None
-    old_price: str | None = None
-    extracted_old_price: float | None = None
-    
-    rating: float | None = None
-    reviews: int | None = None
 
     thumbnail: str | None = None
-    delivery: str | None = None
-    
-    store_rating: float | None = None
-    store_reviews: int | None = None
 
 
 class GoogleShoppingProductsFilterValue(BaseModel):
@@ -41,6 +37,13 @@ class GoogleShoppingProductsResponse(BaseModel):
     shopping_results: list[GoogleShoppingProduct] = Field(default_factory=list)
     related_shopping_results: list[GoogleShoppingProduct] = Field(default_factory=list)
 
+# products kept from earlier SerpAPI responses, see catalog.py
+class CatalogProduct(BaseModel):
+    product: GoogleShoppingProduct
+    location: str
+    amount: float | None = None
+    updated_at: datetime
+
 # Google Product Offers
 class GoogleShoppingProductOfferAdditionalPrice(BaseModel):
     shipping: str | None = None
@@ -57,8 +60,6 @@ class GoogleShoppingProductOffer(BaseModel):
     base_price: str | None = None
     additional_price: GoogleShoppingProductOfferAdditionalPrice | None = None
     total_price: str | None = None
-    offer_id: str | None = None
-    offer_link: str | None = None
 
 class GoogleShoppingProductSellerResultsResponse(BaseModel):
     online_sellers: list[GoogleShoppingProductOffer] = Field(default_factory=list)
@@ -110,6 +111,23 @@ class RecommendedProduct(BaseModel):
     has_more_offers: bool = False
     more_offers_text: str | None = None
 
+class RankedOffer(BaseModel):
+    product_id: str
+    title: str
+    offer: RecommendedProductOffer
+    # UAH, price with shipping and tax, estimated where the offer does not say
+    landed_cost: float
+    shipping_estimated: bool = False
+    tax_estimated: bool = False
+
+class SizeOffers(BaseModel):
+    size: str
+    product_id: str
+    status: Literal["pending", "ok", "failed"] = "pending"
+    # UAH by seller, the lowest when a seller lists the size more than once
+    prices: dict[str, float] = Field(default_factory=dict)
+    cheapest: RecommendedProductOffer | None = None
+
 class ProductFilterValue(BaseModel):
     text: str
     key: str
@@ -122,6 +140,35 @@ class ProductFilter(BaseModel):
 
 
 
+class GetProductsRequest(BaseModel):
+    query: str
+    location: str
+
+class GetProductRequest(BaseModel):
+    product_id: str
+    location: str
+
+class GetSizeOffersRequest(BaseModel):
+    product_id: str
+    location: str
+    # all sizes of the product when left out
+    sizes: list[str] | None = None
+
+class GetCheapestOffersRequest(BaseModel):
+    query: str
+    locations: list[str] | None = None
+    limit: int = Field(default=10, ge=1, le=100)
+
+class GetCheapestOffersResponse(BaseModel):
+    offers: list[RankedOffer]
+
+class GetSizeOffersResponse(BaseModel):
+    product_id: str
+    title: str
+    location: str
+    sellers: list[str] = Field(default_factory=list)
+    sizes: list[SizeOffers] = Field(default_factory=list)
+
 class GetProductsResponse(BaseModel):
     filters: list[ProductFilter] = Field(default_factory=list)
     products: list[RecommendedProduct]
@@ -0,0 +1,302 @@
+from typing import Any
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from cache import normalize_params
+from config import app_settings
+
+logger = logging.getLogger(__name__)
+
+# query parameters that do not change what SerpAPI returns
+IGNORED_PARAMS = {"api_key", "output", "source"}
+
+GL_PRICE_FORMAT = {
+    "us": "${amount:,.2f}",
+    "uk": "£{amount:,.2f}",
+    "pl": "{amount:,.2f} zł",
+    "de": "{amount:,.2f} €",
+    "es": "{amount:,.2f} €",
+}
+
+SYNTHETIC_SIZES = ["6", "7", "8", "8.5", "9", "9.5", "10", "11", "12"]
+SYNTHETIC_SOURCES = ["Nike", "Foot Locker", "JD Sports", "Zalando", "eBay", "StockX", "GOAT", "Amazon"]
+
+
+def request_params(url: str) -> dict[str, Any]:
+    params = dict(parse_qsl(urlsplit(url).query))
+    return normalize_params({k: v for k, v in params.items() if k not in IGNORED_PARAMS})
+
+
+def request_key(params: dict[str, Any]) -> str:
+    raw_key = json.dumps(normalize_params(params), ensure_ascii=False, default=str)
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+def format_price(amount: float, gl: str | None) -> str:
+    price = GL_PRICE_FORMAT.get(gl or "us", GL_PRICE_FORMAT["us"]).format(amount=amount)
+
+    # european formats swap the separators, 1,299.00 -> 1 299,00
+    if gl in ("pl", "de", "es"):
+        price = price.replace(",", " ").replace(".", ",")
+
+    return price
+
+
+def generate_shopping_response(params: dict[str, Any], n_products: int) -> dict[str, Any]:
+    rnd = random.Random(request_key(params))
+    gl = params.get("gl")
+    query = params.get("q") or "product"
+
+    shopping_results = []
+    for idx in range(n_products):
+        product_id = str(rnd.randrange(10**18, 10**19))
+        amount = round(rnd.uniform(20, 400), 2)
+        shopping_results.append({
+            "position": idx + 1,
+            "title": f"{query.title()} #{idx + 1} {rnd.choice(SYNTHETIC_SIZES)}",
+            "link": f"https://shop.example.com/{product_id}",
+            "product_link": f"https://www.google.com/shopping/product/{product_id}?gl={gl}",
+            "product_id": product_id,
+            "source": rnd.choice(SYNTHETIC_SOURCES),
+            "number_of_comparisons": f"{rnd.randint(2, 50)}+" if rnd.random() < 0.7 else None,
+            "price": format_price(amount, gl),
+            "extracted_price": amount,
+            "rating": round(rnd.uniform(3, 5), 1),
+            "reviews": rnd.randint(0, 5000),
+            "thumbnail": f"https://encrypted-tbn0.gstatic.com/shopping?q=tbn:{product_id}",
+            "delivery": "Free delivery",
+        })
+
+    return {
+        "search_metadata": {
+            "status": "Success",
+            "total_time_taken": round(rnd.uniform(2, 9), 2),
+        },
+        "search_parameters": params,
+        "filters": [
+            {
+                "type": "Size",
+                "options": [{"text": size, "tbs": f"mr:1,size:{size}"} for size in SYNTHETIC_SIZES],
+            }
+        ],
+        "shopping_results": shopping_results,
+    }
+
+
+def generate_product_response(params: dict[str, Any], n_sellers: int) -> dict[str, Any]:
+    rnd = random.Random(request_key(params))
+    gl = params.get("gl")
+    product_id = params.get("product_id") or str(rnd.randrange(10**18, 10**19))
+    selected_size = rnd.choice(SYNTHETIC_SIZES)
+
+    online_sellers = []
+    for idx in range(n_sellers):
+        base_amount = round(rnd.uniform(20, 400), 2)
+        shipping_amount = rnd.choice([0, 0, round(rnd.uniform(3, 20), 2)])
+        tax_amount = round(base_amount*rnd.choice([0, 0.06, 0.08]), 2)
+        online_sellers.append({
+            "position": idx + 1,
+            "name": f"{rnd.choice(SYNTHETIC_SOURCES)} {idx + 1}",
+            "top_quality_store": rnd.random() < 0.3,
+            "link": f"https://shop.example.com/{product_id}/{idx}",
+            "base_price": format_price(base_amount, gl),
+            "additional_price": {
+                "shipping": format_price(shipping_amount, gl),
+                "tax": format_price(tax_amount, gl),
+            },
+            "total_price": format_price(base_amount + shipping_amount + tax_amount, gl),
+        })
+
+    return {
+        "search_metadata": {
+            "status": "Success",
+            "total_time_taken": round(rnd.uniform(1, 4), 2),
+        },
+        "search_parameters": params,
+        "product_results": {
+            "product_id": product_id,
+            "title": f"Synthetic product {product_id}",
+            "media": [
+                {"type": "image", "link": f"https://encrypted-tbn0.gstatic.com/shopping?q=tbn:{product_id}-{idx}"}
+                for idx in range(3)
+            ],
+            "sizes": {
+                size: {"product_id": f"{product_id}{idx}", "selected": size == selected_size}
+                for idx, size in enumerate(SYNTHETIC_SIZES)
+            },
+        },
+        "sellers_results": {"online_sellers": online_sellers},
+    }
+
+
+class SerpRecordings:
+
+    def __init__(self, directory: str) -> None:
+        self.directory = Path(directory)
+
+    def path(self, params: dict[str, Any]) -> Path:
+        return self.directory / str(params.get("engine", "unknown")) / f"{request_key(params)}.json"
+
+    def load(self, params: dict[str, Any]) -> bytes | None:
+        path = self.path(params)
+        return path.read_bytes() if path.exists() else None
+
+    def save(self, params: dict[str, Any], content: bytes) -> None:
+        path = self.path(params)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(content)
+        tmp_path.replace(path)
+
+
+class SerpReplay:
+
+    def __init__(
+        self,
+        recordings: SerpRecordings,
+        latency: float = 0,
+        latency_jitter: float = 0,
+        error_rate: float = 0,
+        synthetic_results: int = 0,
+    ) -> None:
+        self.recordings = recordings
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.synthetic_results = synthetic_results
+
+        self._random = random.Random()
+        self._random_lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._random_lock:
+            return max(0.0, self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+
+    def should_fail(self) -> bool:
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def respond(self, params: dict[str, Any]) -> tuple[int, bytes]:
+        if self.should_fail():
+            return 503, json.dumps({"error": "Injected replay error"}).encode("utf-8")
+
+        content = self.recordings.load(params)
+        if content is not None:
+            return 200, content
+
+        if self.synthetic_results:
+            if params.get("engine") == "google_product":
+                response = generate_product_response(params, n_sellers=self.synthetic_results)
+            else:
+                response = generate_shopping_response(params, n_products=self.synthetic_results)
+            return 200, json.dumps(response, ensure_ascii=False).encode("utf-8")
+
+        logger.warning(f"No recorded SERP response for {params}")
+        return 404, json.dumps({"error": "No recorded response for this search"}).encode("utf-8")
+
+
+class RecordingAdapter(HTTPAdapter):
+
+    def __init__(self, recordings: SerpRecordings, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.recordings = recordings
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 200 and urlsplit(request.url).path == "/search":
+            self.recordings.save(request_params(request.url), response.content)
+
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self, replay: SerpReplay) -> None:
+        super().__init__()
+        self.replay = replay
+
+    def send(self, request: requests.PreparedRequest, stream=False, timeout=None, verify=True, cert=None, proxies=None) -> requests.Response:
+        delay = self.replay.delay()
+
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and delay > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.exceptions.ReadTimeout(f"Replay response took longer than {read_timeout}s", request=request)
+
+        time.sleep(delay)
+
+        status_code, content = self.replay.respond(request_params(request.url))
+
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = content
+        response.headers["Content-Type"] = "application/json; charset=utf-8"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "OK" if status_code == 200 else "Replay error"
+
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def create_serp_replay() -> SerpReplay:
+    return SerpReplay(
+        recordings=SerpRecordings(app_settings.serp_recordings_dir),
+        latency=app_settings.serp_replay_latency,
+        latency_jitter=app_settings.serp_replay_latency_jitter,
+        error_rate=app_settings.serp_replay_error_rate,
+        synthetic_results=app_settings.serp_replay_synthetic_results,
+    )
+
+
+def serve(host: str, port: int) -> None:
+    replay = create_serp_replay()
+
+    class SerpReplayHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            if urlsplit(self.path).path != "/search":
+                self.send_error(404)
+                return
+
+            time.sleep(replay.delay())
+            status_code, content = replay.respond(request_params(self.path))
+
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args) -> None:
+            logger.info(format % args)
+
+    server = ThreadingHTTPServer((host, port), SerpReplayHandler)
+    logger.info(f"Serving recorded SERP responses from {app_settings.serp_recordings_dir} on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SerpAPI stand-in serving recorded or synthetic responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(host=args.host, port=args.port)
@@ -0,0 +1,62 @@
+from typing import Any, Callable, Hashable, TypeVar
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _Call:
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args, retry_on_error: bool = True, **kwargs) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not is_leader:
+            call.done.wait()
+
+            if call.error is None:
+                return call.result
+
+            # a failed call is never handed over: the waiters run one more shared
+            # attempt of their own, and only its failure is reported to them
+            if retry_on_error:
+                logger.info(f"Shared call for {key} failed, retrying for {call.waiters} waiting caller(s)")
+                return self.do(key, fn, *args, retry_on_error=False, **kwargs)
+
+            raise call.error
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)